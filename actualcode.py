@@ -1,24 +1,165 @@
 import bpy
+import json
 import math
+import os
+import sys
+import threading
+import time
+import zlib
 import numpy as np
 import taichi as ti
-import bmesh
 
-# Инициализация Taichi с поддержкой Vulkan
-ti.init(arch=ti.vulkan)
-ti.init(debug=True)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # соседние модули проекта
+import density_core
+import density_lod
+import density_tune
+import frame_timing
+import scene_mesh
+from density_cache import DensityCache
+from density_prefetch import DensityPrefetcher
+from density_store import DensityReader
+from point_cache import PointCacheReader, cache_prefix
+
+# Инициализация Taichi: 'auto' пробует CUDA и Vulkan и откатывается на CPU,
+# можно указать 'cpu' или 'vulkan'. Debug (проверки границ) только для отладки
+TAICHI_ARCH = 'auto'
+TAICHI_DEBUG = False
+TAICHI_OFFLINE_CACHE = True  # скомпилированные ядра кешируются на диске между запусками
+# Замеры времени стадий кадра (см. frame_timing), выключенные ничего не стоят.
+# TIMING_KERNEL_PROFILER добавляет время ядер из профилировщика Taichi (CPU и CUDA)
+TIMING = False
+TIMING_FRAMES = 256  # размер кольцевого буфера кадров
+TIMING_KERNEL_PROFILER = False
+TIMING_DUMP_PATH = "density_timing.json"  # .json или .csv, пишется на последнем кадре сцены
+# Трассировка ядер (density_core.TRACE): выборка частиц и плотностей в вершинах - каждый
+# TRACE_STRIDE-й элемент и TRACE_INDICES - копится на устройстве и раз в кадр дописывается
+# строкой JSON в TRACE_LOG_PATH. Выключенная не компилируется в ядра. Значения - до нормировки
+# 'max', её множитель на строку - в поле "scales"; с DENSITY_LOD - в узлах решётки до интерполяции
+TAICHI_TRACE = False
+TRACE_LOG_PATH = "density_trace.jsonl"
+density_core.TRACE_STRIDE = 1024
+density_core.TRACE_INDICES = ()
+density_core.init(arch=TAICHI_ARCH, debug=TAICHI_DEBUG, offline_cache=TAICHI_OFFLINE_CACHE,
+                  kernel_profiler=TIMING and TIMING_KERNEL_PROFILER, trace=TAICHI_TRACE)
 
 # Константы
 PARTICLE_COUNT = 1000
 CYLINDER_RADIUS = 3.0
 CYLINDER_HEIGHT = 15.0
+CYLINDER_SEGMENTS = 32
+SUBDIVISION_LEVELS = 2  # разрешение цилиндра как после модификатора Subdivision этого уровня
+
+# Параметры ядра плотности
+SMOOTHING_LENGTH = CYLINDER_RADIUS/2  # h
+# Ядро сглаживания из density_core.KERNELS: 'gaussian', 'cubic_spline', 'wendland_c2', 'poly6'.
+# У SPH-ядер носитель 2h, гаусс в режиме 'grid' обрезается на CUTOFF_FACTOR * h
+DENSITY_KERNEL = 'gaussian'
+CUTOFF_FACTOR = 3.0
+# 'grid' - поиск соседей по равномерной сетке, 'brute' - эталонный перебор всех пар,
+# 'fft' - быстрое приближение через БПФ на сетке (theta, z) цилиндра,
+# 'large' - для 1e5-1e6 частиц (PARTICLE_COUNT): частицы кусками, координаты во float16
+# при LARGE_HALF (память на частицу - в density_core у LARGE_CHUNK)
+DENSITY_MODE = 'grid'
+LARGE_HALF = True
+CHECK_ACCURACY = False  # сравнивать DENSITY_MODE с 'brute' на каждом кадре
+# Инкрементальное обновление при воспроизведении подряд (только для 'grid'): пересчитываются
+# вклады частиц, сдвинувшихся больше чем на INCREMENTAL_TOLERANCE, полный пересчёт -
+# при скачках по таймлайну и каждые INCREMENTAL_REFRESH кадров
+INCREMENTAL_UPDATES = True
+INCREMENTAL_TOLERANCE = 1e-3
+INCREMENTAL_REFRESH = 50
+# Нормировка плотности: 'max' - на максимум текущего кадра, 'fixed' - на DENSITY_REFERENCE,
+# 'none' - без нормировки ('fixed' и 'none' не требуют второго прохода)
+NORMALIZATION = 'max'
+DENSITY_REFERENCE = 1.0
+# LOD: плотность считается в узлах грубой решётки с шагом LOD_SPACING * h вокруг цилиндра
+# и интерполируется на вершины, время ядра не зависит от уровня подразделения (см. density_lod)
+DENSITY_LOD = False
+LOD_SPACING = density_lod.LOD_SPACING
+# Асинхронный режим: пока показывается кадр N, фоновый поток считает плотность следующих
+# ASYNC_DEPTH кадров по траектории частиц, записанной из запечённого кеша в main(), а с
+# POINT_CACHE_DISK - прямо по файлам дискового кеша. При промахе кадр считается синхронно, как без него
+ASYNC_PREFETCH = False
+ASYNC_DEPTH = 2
+# Дисковый кеш частиц: main() запекает кеш эмиттеров на диск без сжатия, и частицы кадра
+# читаются прямо из файлов кеша (point_cache.py) вместо вычисления depsgraph. Траектория
+# для ASYNC_PREFETCH и запечка bake.py тогда обходятся без frame_set по всем кадрам
+POINT_CACHE_DISK = False
+POINT_CACHE_DIR = None  # None - папка кеша Блендера: blendcache_<имя .blend> рядом с файлом
+# Запечка (bake.py) считает кадры пакетами по BATCH_FRAMES одним запуском ядра
+BATCH_FRAMES = 8
+# Автоподбор при запуске (density_tune): DENSITY_MODE, LARGE_HALF, ячейка режима 'large',
+# block_dim ядер, BATCH_FRAMES и, если задан TUNE_THREADS, число потоков CPU. Первый запуск на машине с новым
+# размером задачи делает короткие замеры, следующие сразу берут сохранённое из TUNE_PATH.
+# Инкрементальный режим остаётся только поверх 'grid'
+AUTO_TUNE = False
+TUNE_PATH = density_tune.TUNE_PATH
+TUNE_THREADS = ()  # например (1, 4, 8)
+# Приёмники плотности и эмиттеры частиц по именам объектов. Частицы всех эмиттеров
+# собираются в один массив, вершины всех приёмников - в один буфер, и кадр считается
+# одним запуском ядра. Куб из main() называется "Collision_Cube" и может быть приёмником
+RECEIVERS = ("Hollow_Cylinder",)
+EMITTERS = ("Particle_Emitter",)
+
+cylinder_obj = None  # первый приёмник
+receiver_objs = []
+frame_buffers = {}  # numpy-буферы update_density, переиспользуются между кадрами
+
+# Вершины приёмников живут на устройстве и перезагружаются только при изменении мешей.
+# Один приёмник хранится в локальных координатах и считается с его matrix_world,
+# несколько - в мировых координатах с единичной матрицей
+receiver_verts = None  # ti.ndarray(vec3)
+receiver_key = None  # данные загруженного буфера: receiver_mesh_key, для нескольких приёмников - и их матрицы
+receiver_mesh_key = None  # (число вершин, crc32 координат) мешей в их локальных координатах
+receiver_bounds = None  # (min, max) вершин в координатах буфера
+receiver_world = None  # matrix_world для вершин буфера
+receiver_offsets = None  # вершины приёмника r - срез [offsets[r], offsets[r + 1])
 
-cylinder_obj = None
+# Решётка LOD для текущего меша: узлы на устройстве и на хосте, веса интерполяции
+lod_nodes = None  # ti.ndarray(vec3)
+lod_points = None  # (M, 3) numpy
+lod_index = None
+lod_weights = None
+lod_bounds = None
+lod_key = None
 
+# Запечённая плотность (см. bake.py): memmap кадры x вершины и номер первого кадра.
+# Файл .npy (float32) или квантованный .dens (density_store)
+DENSITY_BAKE_PATH = "density_bake.npy"  # относительный путь считается от .blend файла
+density_bake = None
+density_bake_start = 0
+density_bake_meta = None  # .json запечки: кадры, параметры ядра и отпечаток сцены
+density_bake_state = None  # отпечаток сцены, для которого запечка проверена
+density_bake_valid = False
+
+# Кеш посчитанных кадров для перемотки по таймлайну
+DENSITY_CACHE_MB = 512
+frame_cache = DensityCache(DENSITY_CACHE_MB)
+incremental = density_core.IncrementalDensity(INCREMENTAL_TOLERANCE, INCREMENTAL_REFRESH)
+first_frame_reported = False
+timer = None  # frame_timing.FrameTimer, создаётся в main() при TIMING
+
+# Все вызовы density_core идут под этим замком: при ASYNC_PREFETCH ядра запускает и фоновый поток,
+# и он держит замок весь расчёт кадра. Обработчик кадра берёт замок только для расчёта при
+# промахе и для перезагрузки изменившихся мешей на устройство; проверки (frame_state, кеш,
+# готовые фоновые кадры) идут без него и не ждут фоновый расчёт.
+# Повторно входимый: синхронизация приёмников берёт его и сама, и внутри расчёта кадра
+density_lock = threading.RLock()
+prefetcher = None  # DensityPrefetcher, создаётся в main() при ASYNC_PREFETCH
+# Траектория частиц для фонового расчёта без дискового кеша: (первый кадр, координаты (F, P, 3),
+# живые (F, P), проверки кадров particle_check (F,)) - около 13 * F * P байт в памяти,
+# 3 ГБ на 250 кадров по 1e6 частиц. С дисковым кешем траектория не пишется: фоновый поток
+# читает нужные кадры своими читателями файлов (prefetch_readers), это numpy без bpy.
+# particle_track_state - отпечаток частиц (particle_state), для которого она записана
+particle_track = None
+particle_track_state = None
+prefetch_readers = None
+prefetch_buffers = {}  # буферы частиц фонового потока для чтения из prefetch_readers
+track_recording = False  # идёт проход frame_set (траектория, check_point_cache): обработчик кадра ничего не делает
+track_scheduled = False  # перезапись устаревшей траектории ждёт таймера
+point_caches = None  # PointCacheReader на эмиттер при POINT_CACHE_DISK, в порядке EMITTERS
+point_cache_state = None
 
-# Taichi поля
-particles_pos = ti.Vector.field(3, dtype=ti.f32, shape=PARTICLE_COUNT)
-density_field = ti.field(dtype=ti.f32, shape=PARTICLE_COUNT)  # Явно указана форма
 
 def clear_scene():
     # Удаляем все обработчики перед очисткой сцены
@@ -26,117 +167,53 @@ def clear_scene():
         if "update_density" in handler.__name__:
             bpy.app.handlers.frame_change_pre.remove(handler)
     
-    bpy.ops.object.select_all(action='SELECT')
-    bpy.ops.object.delete()
+    for ob in list(bpy.context.scene.objects):
+        bpy.data.objects.remove(ob, do_unlink=True)
 
 
-def create_hollow_cylinder(radius=3.0, height=5.0, thickness=0.5):
-    bpy.ops.mesh.primitive_cylinder_add(radius=radius, depth=height)
-    outer = bpy.context.object
-    outer.name = "Outer_Cylinder"
-    
-    if outer and outer.type == 'MESH':
-    # Переходим в режим редактирования
-        bpy.ops.object.mode_set(mode='EDIT')
-        mesh = bmesh.from_edit_mesh(outer.data)
-         # Выбираем все полигоны
-        bpy.ops.mesh.select_all(action='SELECT')
-        
-        # Переключаемся в режим вершин (чтобы корректно выделить грани)
-        bpy.ops.mesh.select_mode(type='FACE')
-        
-        # Выделяем только полигоны, перпендикулярные оси Z (верх/низ)
-        for face in mesh.faces:
-            normal = face.normal
-            if abs(normal.z) > 0.99:  # Если нормаль почти по Z (верх/низ)
-                face.select = True
-            else:
-                face.select = False
-        
-        # Удаляем выделенные полигоны (верх и низ)
-        bpy.ops.mesh.delete(type='FACE')
-        
-        # Обновляем сетку
-        bmesh.update_edit_mesh(outer.data)
-        
-        # Возвращаемся в объектный режим
-        bpy.ops.object.mode_set(mode='OBJECT')
-        
-        #print("Круглые полигоны удалены, осталась только боковая поверхность!")
-    else:
-        print("Активный объект не является мешем или не выбран!")
-    
-    outer.modifiers.new(name="Collision", type='COLLISION')
+def add_object(name, data, location=(0, 0, 0), rotation=(0, 0, 0), scale=(1, 1, 1)):
+    # Объект в текущей коллекции без операторов: не нужен контекст окна, работает в --background
+    ob = bpy.data.objects.new(name, data)
+    ob.location = location
+    ob.rotation_euler = rotation
+    ob.scale = scale
+    bpy.context.collection.objects.link(ob)
+    return ob
 
-    #bpy.data.objects.remove(inner)
-    
-    outer.name = "Hollow_Cylinder"
-    
-    # Инициализируем поле плотности по количеству вершин
-    density_field = ti.field(dtype=ti.f32, shape=len(outer.data.vertices))
+
+def add_mesh_object(name, verts, faces, **transform):
+    # Меш из массивов numpy (scene_mesh)
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(verts.tolist(), [], faces.tolist())
+    mesh.update()
+    return add_object(name, mesh, **transform)
+
+
+def create_hollow_cylinder(radius=3.0, height=5.0, thickness=0.5, segments=CYLINDER_SEGMENTS,
+                           level=SUBDIVISION_LEVELS, rotation=(0, 0, 0)):
+    # Открытый цилиндр сразу в разрешении подразделения (см. scene_mesh.open_cylinder).
+    # Поворот задаётся объекту, а меш остаётся с осью по локальной Z - так его ждёт режим 'fft'
+    verts, faces = scene_mesh.open_cylinder(radius, height, segments, level)
+    outer = add_mesh_object("Hollow_Cylinder", verts, faces, rotation=rotation)
+    outer.modifiers.new(name="Collision", type='COLLISION')
     return outer
 
-@ti.kernel
-def update_particles(particles: ti.types.ndarray(dtype=ti.math.vec3)):  # Добавляем параметр скорости
-    for i in range(particles.shape[0]):
-        particles_pos[i] = particles[i]
-        print(f"Particle {i}: pos=({particles_pos[i][0]},{particles_pos[i][1]}, {particles_pos[i][2]})\n")
-
-@ti.kernel
-def calculate_density(vertices: ti.types.ndarray(dtype=ti.math.vec3), 
-                     density_out: ti.types.ndarray(dtype=ti.f32)):
-    maxdist = 0.0
-    for i in range(vertices.shape[0]):
-        vert_pos = vertices[i]
-        #print(f"Vertex {i}: pos=({vert_pos[0]},{vert_pos[1]}, {vert_pos[2]})\n")
-        density = 0.0
-        
-        h = CYLINDER_RADIUS/2
-        
-        
-        
-        for j in range(PARTICLE_COUNT):
-            dist = (vert_pos - particles_pos[j]).norm()  #dist = (vert_pos - particles_pos[j]).norm()
-            #print(f"Vertex {i} pos {vert_pos} : dist {j} pos {particles_pos[j]} = {dist}\n")
-            influence = ti.exp(-(dist * dist) / (2.0 * h * h))
-            density += influence
-            
-        if maxdist < density: maxdist = density   
-
-            
-        density_out[i] = density #/ maxdist  # Явная нормировка
-
-    for i1 in range(vertices.shape[0]):
-        density_out[i1] = density_out[i1] / maxdist
-        print(f"Vertex {i1} - Final density: {density_out[i1]}, maxdist {maxdist} \n")
-
-""" @ti.kernel
-def calculate_density(vertices: ti.types.ndarray(dtype=ti.math.vec3), 
-                     density_out: ti.types.ndarray(dtype=ti.f32)):
-    # Используем ti.template() для статической проверки
-    for i in ti.static(range(5)):  # Выводим только первые 5 вершин
-        vert_pos = vertices[i]
-        #print(f"Vertex {i}: pos=({vert_pos[0]},{vert_pos[1]}, {vert_pos[2]})\n")
-    
-    # Основной расчет
-    for i in range(vertices.shape[0]):
-        vert_pos = vertices[i]
-        density = 0.0
-        for j in range(PARTICLE_COUNT):
-            dist = (vert_pos - particles_pos[j]).norm()
-            density += ti.exp(-(dist * dist) / (2.0 * 0.2 * 0.2))
-        density_out[i] = density / PARTICLE_COUNT """
-
-def setup_density_visualization(cylinder):
-    global cylinder_obj
-    cylinder_obj = cylinder  # Сохраняем ссылку
+def set_receivers(receivers):
+    # Запоминает приёмники и создаёт на каждом атрибут плотности
+    global cylinder_obj, receiver_objs
+    if DENSITY_MODE == 'fft' and len(receivers) > 1:
+        raise ValueError("Режим 'fft' считает только один цилиндр-приёмник")
+    receiver_objs = list(receivers)
+    cylinder_obj = receiver_objs[0]
+    for obj in receiver_objs:
+        # Удаляем старый атрибут если существует
+        if "density" in obj.data.attributes:
+            obj.data.attributes.remove(obj.data.attributes["density"])
+        obj.data.attributes.new(name="density", type='FLOAT', domain='POINT')
+
+def setup_density_visualization(receivers):
+    set_receivers(receivers)
     print(f"check\n")
-    # Удаляем старый атрибут если существует
-    if "density" in cylinder.data.attributes:
-        cylinder.data.attributes.remove(cylinder.data.attributes["density"])
-    
-    # Создаем новый атрибут
-    density_attr = cylinder.data.attributes.new(name="density", type='FLOAT', domain='POINT')
     
     # Создаем материал
     if "DensityMaterial" not in bpy.data.materials:
@@ -186,40 +263,568 @@ def setup_density_visualization(cylinder):
         mat = bpy.data.materials["DensityMaterial"]
     
     # Назначаем материал
-    if cylinder.data.materials:
-        cylinder.data.materials[0] = mat
+    for obj in receiver_objs:
+        if obj.data.materials:
+            obj.data.materials[0] = mat
+        else:
+            obj.data.materials.append(mat)
+
+def frame_buffer(name, shape, dtype=np.float32):
+    # Возвращает буфер нужной формы, пересоздаёт его только при изменении размеров
+    buf = frame_buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        frame_buffers[name] = buf
+    return buf
+
+def capacity_buffer(name, n, tail=(), dtype=np.float32):
+    # Буфер на n строк с запасом: ёмкость растёт геометрически, возвращается срез [:n].
+    # Для данных, размер которых меняется каждый кадр (число живых частиц)
+    buf = frame_buffers.get(name)
+    if buf is None or buf.shape[0] < n or buf.shape[1:] != tail or buf.dtype != dtype:
+        capacity = max(n, 2 * buf.shape[0]) if buf is not None and buf.shape[1:] == tail else n
+        buf = np.empty((capacity,) + tail, dtype=dtype)
+        frame_buffers[name] = buf
+    return buf[:n]
+
+def read_particles(particles, frame):
+    # Координаты всех частиц системы (индекс частицы постоянен между кадрами) и маска живых:
+    # ещё не родившиеся и уже умершие не считаются. Состояние восстанавливается по времени
+    # рождения и смерти - это пакетные float-чтения, в отличие от перечисления alive_state,
+    # которое пришлось бы читать по одной частице
+    n = len(particles)
+    part_data = capacity_buffer("particles", n, (3,))
+    particles.foreach_get("location", part_data.ravel())
+    birth = capacity_buffer("birth_time", n)
+    particles.foreach_get("birth_time", birth)
+    death = capacity_buffer("die_time", n)
+    particles.foreach_get("die_time", death)
+    alive = capacity_buffer("alive", n, dtype=np.bool_)
+    particles.foreach_get("is_exist", alive)
+    mask = capacity_buffer("alive_mask", n, dtype=np.bool_)
+    np.less_equal(birth, frame, out=mask)
+    alive &= mask
+    np.greater(death, frame, out=mask)
+    alive &= mask
+    return part_data, alive
+
+def emitter_objects():
+    # Эмиттеры из EMITTERS, которые есть в сцене и имеют систему частиц
+    objects = (bpy.data.objects.get(name) for name in EMITTERS)
+    return [ob for ob in objects if ob and ob.particle_systems]
+
+def simulation_objects():
+    # Объекты, от которых зависит симуляция частиц: эмиттеры, коллайдеры и силовые поля
+    return [ob for ob in bpy.context.scene.objects
+            if ob.particle_systems or any(m.type == 'COLLISION' for m in ob.modifiers)
+            or (ob.field is not None and ob.field.type != 'NONE')]
+
+def emitter_systems():
+    # Активные системы частиц эмиттеров после вычисления depsgraph
+    dg = bpy.context.evaluated_depsgraph_get()
+    return [ob.evaluated_get(dg).particle_systems.active for ob in emitter_objects()]
+
+def point_cache_dir():
+    # Папка дискового кеша или None: у несохранённого файла Блендер дисковый кеш не включает
+    if POINT_CACHE_DIR:
+        return bpy.path.abspath(POINT_CACHE_DIR)
+    if bpy.data.filepath:
+        name = os.path.splitext(os.path.basename(bpy.data.filepath))[0]
+        return os.path.join(os.path.dirname(bpy.data.filepath), "blendcache_" + name)
+    return None
+
+def point_cache_readers(state):
+    # Читатели дискового кеша эмиттеров для отпечатка частиц state (particle_state, при его
+    # смене открываются заново); None, если кеш не на диске или ещё не запечён
+    global point_caches, point_cache_state
+    if not POINT_CACHE_DISK or state == point_cache_state:
+        return point_caches
+    point_cache_state = state
+    point_caches = None
+    readers = []
+    directory = point_cache_dir()
+    for ob in emitter_objects():
+        cache = ob.particle_systems.active.point_cache
+        reader = None
+        if cache.use_disk_cache and directory:
+            reader = PointCacheReader(directory, cache_prefix(cache.name, ob.name), cache.index)
+        if reader is None or not len(reader.frames):
+            print(f"No disk point cache for {ob.name} in {directory}, reading particles via depsgraph")
+            return None
+        readers.append(reader)
+    if readers:
+        point_caches = readers
+        print(f"Point cache: {sum(len(r) for r in readers)} particles, "
+              f"frames {min(r.frames[0] for r in readers)}-{max(r.frames[-1] for r in readers)}")
+    return point_caches
+
+def cached_particles(frame):
+    # То же, что gather_particles, но из файлов дискового кеша
+    counts = [len(reader) for reader in point_caches]
+    positions = capacity_buffer("all_particles", sum(counts), (3,))
+    alive = capacity_buffer("all_alive", sum(counts), dtype=np.bool_)
+    offset = 0
+    for reader, n in zip(point_caches, counts):
+        reader.read(frame, positions[offset:offset + n], alive[offset:offset + n])
+        offset += n
+    return positions, alive
+
+def check_point_cache(frames=None):
+    # Сверка файлов дискового кеша (PointCacheReader) с depsgraph (read_particles) на кадрах
+    # frames, по умолчанию всех кадрах сцены: маски живых должны совпасть, координаты живых
+    # частиц - с точностью float32. Возвращает наибольшее расхождение координат и число
+    # несовпавших масок или None, если запечённого дискового кеша нет
+    global track_recording
+    scene = bpy.context.scene
+    readers = point_cache_readers(particle_state())
+    if not readers:
+        return None
+    frames = range(scene.frame_start, scene.frame_end + 1) if frames is None else frames
+    current = scene.frame_current
+    max_err, mismatches = 0.0, 0
+    track_recording = True
+    try:
+        for frame in frames:
+            scene.frame_set(frame)
+            for reader, ps in zip(readers, emitter_systems()):
+                positions, alive = reader.read(frame)
+                live_positions, live_alive = read_particles(ps.particles, frame)
+                if len(live_alive) != len(alive) or (live_alive != alive).any():
+                    mismatches += 1
+                elif alive.any():
+                    max_err = max(max_err, float(np.abs(positions[alive] - live_positions[alive]).max()))
+    finally:
+        track_recording = False
+    scene.frame_set(current)
+    print(f"Point cache check ({len(frames)} frames): max position error {max_err:.3g}, "
+          f"{mismatches} alive mask mismatches")
+    return max_err, mismatches
+
+def gather_particles(frame, systems=None):
+    # Частицы всех эмиттеров подряд: координаты и маска живых, как у read_particles.
+    # Порядок эмиттеров постоянен, поэтому индекс частицы постоянен между кадрами.
+    # С открытым дисковым кешем частицы читаются из его файлов, systems не нужны
+    if point_caches:
+        return cached_particles(frame)
+    systems = emitter_systems() if systems is None else systems
+    counts = [len(ps.particles) for ps in systems]
+    if len(systems) == 1:
+        return read_particles(systems[0].particles, frame)
+    positions = capacity_buffer("all_particles", sum(counts), (3,))
+    alive = capacity_buffer("all_alive", sum(counts), dtype=np.bool_)
+    offset = 0
+    for ps, n in zip(systems, counts):
+        positions[offset:offset + n], alive[offset:offset + n] = read_particles(ps.particles, frame)
+        offset += n
+    return positions, alive
+
+def compact_particles(part_data, alive):
+    # Только живые частицы, уплотнённые в один массив
+    out = capacity_buffer("alive_particles", int(np.count_nonzero(alive)), (3,))
+    np.compress(alive, part_data, axis=0, out=out)
+    return out
+
+def alive_particles(frame, systems=None):
+    # Координаты только живых частиц всех эмиттеров
+    return compact_particles(*gather_particles(frame, systems))
+
+def current_particles(state=None):
+    # Частицы текущего кадра для update_density (координаты и маска живых) или None,
+    # если эмиттеров нет. state - отпечаток частиц из particle_state()
+    if POINT_CACHE_DISK:
+        point_cache_readers(state or particle_state())
+    systems = None if point_caches else emitter_systems()
+    if not point_caches and not systems:
+        return None
+    return gather_particles(bpy.context.scene.frame_current_final, systems)
+
+def particle_check(positions, alive):
+    # crc32 координат живых частиц и маски живых - проверка кадра в кеше и запечке: после
+    # перезапечки частицы другие, даже если ни одна настройка не поменялась. Координаты
+    # ещё не родившихся и умерших не входят: Блендер оставляет в них значения, зависящие
+    # от того, какие кадры вычислялись перед этим
+    return zlib.crc32(alive, zlib.crc32(np.compress(alive, positions, axis=0)))
+
+def receivers_valid():
+    return bool(receiver_objs) and all(obj.name in bpy.data.objects for obj in receiver_objs)
+
+def sync_receivers():
+    # Загружает вершины всех приёмников на устройство одним буфером, только если меши
+    # изменились. Проверка - число вершин и crc32 координат: чтение co через foreach_get
+    # и crc32 выполняются в C и намного дешевле повторной загрузки на устройство.
+    # Матрица одного приёмника передаётся в ядро отдельно, поэтому его сдвиг только меняет
+    # receiver_world; несколько приёмников переводятся в мировые координаты в самом буфере,
+    # и их сдвиг - перезагрузка. Координаты читаются в буфер "receiver_co", который трогает
+    # только основной поток, поэтому проверка идёт без замка. Буфер "verts", вершины на
+    # устройстве и их матрицу читает фоновый поток - они меняются под density_lock
+    global receiver_verts, receiver_key, receiver_bounds, receiver_world, receiver_offsets, receiver_mesh_key
+    offsets = np.cumsum([0] + [len(obj.data.vertices) for obj in receiver_objs])
+    co = frame_buffer("receiver_co", (int(offsets[-1]), 3))
+    for obj, a, b in zip(receiver_objs, offsets[:-1], offsets[1:]):
+        obj.data.vertices.foreach_get("co", co[a:b].ravel())
+    receiver_mesh_key = (len(co), zlib.crc32(co))
+    if len(receiver_objs) == 1:
+        world = np.array(cylinder_obj.matrix_world, dtype=np.float32)
+        key = receiver_mesh_key
     else:
-        cylinder.data.materials.append(mat)
+        matrices = [np.array(obj.matrix_world, dtype=np.float32) for obj in receiver_objs]
+        for m, a, b in zip(matrices, offsets[:-1], offsets[1:]):
+            co[a:b] = co[a:b] @ m[:3, :3].T + m[:3, 3]
+        world = np.eye(4, dtype=np.float32)
+        key = (receiver_mesh_key, b"".join(m.tobytes() for m in matrices))
+    if key != receiver_key:
+        with density_lock:
+            frame_buffer("verts", co.shape)[:] = co
+            if receiver_verts is None or receiver_verts.shape[0] != len(co):
+                receiver_verts = ti.ndarray(dtype=ti.math.vec3, shape=len(co))
+            receiver_verts.from_numpy(co)
+            receiver_bounds = (co.min(axis=0), co.max(axis=0))
+            receiver_world = world
+            receiver_offsets = offsets
+            receiver_key = key
+    elif not np.array_equal(world, receiver_world):
+        with density_lock:
+            receiver_world = world
+    return receiver_verts
 
-def update_density(scene):
-    global cylinder_obj
-    
-    # Проверяем, что объекты существуют
-    if not cylinder_obj or not cylinder_obj.name in bpy.data.objects:
+def sync_lod():
+    # Перестраивает решётку LOD при смене мешей или h; вызывается после sync_receivers.
+    # Решётку читает фоновый поток, поэтому перестройка - под density_lock
+    global lod_nodes, lod_points, lod_index, lod_weights, lod_bounds, lod_key
+    key = (receiver_key, SMOOTHING_LENGTH * LOD_SPACING)
+    if key != lod_key:
+        with density_lock:
+            lod_points, lod_index, lod_weights = density_lod.build_lod(frame_buffers["verts"], key[1])
+            lod_nodes = ti.ndarray(dtype=ti.math.vec3, shape=len(lod_points))
+            lod_nodes.from_numpy(lod_points)
+            lod_bounds = (lod_points.min(axis=0), lod_points.max(axis=0))
+            lod_key = key
+    return lod_nodes
+
+def density_bake_file(path=DENSITY_BAKE_PATH):
+    # Относительные пути считаются от сохранённого .blend, иначе от текущей папки
+    if not os.path.isabs(path) and bpy.data.filepath:
+        return bpy.path.abspath("//" + path)
+    return os.path.abspath(path)
+
+def load_density_bake(path=DENSITY_BAKE_PATH):
+    # Подключает запечённую плотность, если файл есть; массив не читается целиком,
+    # update_density берёт из memmap только строку текущего кадра. Подходит ли запечка
+    # к сцене (параметры ядра, меши, частицы), проверяет baked_density
+    global density_bake, density_bake_start, density_bake_meta, density_bake_state
+    path = density_bake_file(path)
+    density_bake_state = None
+    if not os.path.exists(path) or not os.path.exists(path + ".json"):
+        density_bake = density_bake_meta = None
+        return False
+    with open(path + ".json") as f:
+        density_bake_meta = json.load(f)
+    # .dens читается так же по строкам, кадр распаковывается из своего куска
+    density_bake = DensityReader(path) if path.endswith(".dens") else np.load(path, mmap_mode='r')
+    density_bake_start = density_bake_meta["frame_start"]
+    print(f"Density bake: {path}, frames {density_bake_meta['frame_start']}-{density_bake_meta['frame_end']}")
+    return True
+
+def kernel_params():
+    # Параметры расчёта, от которых зависит плотность: пишутся в .json запечки
+    return {"smoothing_length": SMOOTHING_LENGTH, "kernel": DENSITY_KERNEL, "cutoff_factor": CUTOFF_FACTOR,
+            "mode": DENSITY_MODE, "normalization": NORMALIZATION, "reference": DENSITY_REFERENCE,
+            "lod": DENSITY_LOD, "lod_spacing": LOD_SPACING, "large_half": LARGE_HALF}
+
+def bake_fingerprint(particles):
+    # Отпечаток сцены для .json запечки, один на все кадры: настройки частиц (particle_state)
+    # и меши приёмников в локальных координатах (после sync_receivers). Положения объектов
+    # анимируются, поэтому не входят; сами частицы сверяются по кадрам (particle_checks)
+    return {"particles": "%08x" % zlib.crc32(repr(particles).encode()),
+            "receivers": "%08x" % zlib.crc32(repr(receiver_mesh_key).encode())}
+
+def bake_mismatch(meta, state):
+    # Почему запечка не подходит к сцене, или None. Запечка вне Блендера (point_cache.py)
+    # не знает отпечатка сцены - тогда сверяются только параметры ядра
+    names = [obj.name for obj in receiver_objs]
+    if meta.get("objects", names) != names:
+        return f"receivers {meta['objects']} != {names}"
+    if meta["vertices"] != sum(len(obj.data.vertices) for obj in receiver_objs):
+        return f"{meta['vertices']} vertices, the receivers have {sum(len(obj.data.vertices) for obj in receiver_objs)}"
+    if "kernel" not in meta:
+        return "no kernel parameters recorded, re-bake"
+    current = kernel_params()
+    changed = [f"{name} {meta['kernel'].get(name)!r} != {value!r}" for name, value in current.items()
+               if meta["kernel"].get(name) != value]
+    if changed:
+        return ", ".join(changed)
+    fingerprint = bake_fingerprint(state[0])
+    for part in ("particles", "receivers"):
+        if part in meta.get("fingerprint", {}) and meta["fingerprint"][part] != fingerprint[part]:
+            return f"{part} changed since the bake"
+    return None
+
+def baked_density(frame, state, check):
+    # Строка запечённой плотности для кадра или None, если кадра нет в запечке или она
+    # посчитана для другой сцены. Настройки сверяются только при смене отпечатка state,
+    # частицы - на каждом кадре: check (particle_check) против записанного при запечке
+    global density_bake_state, density_bake_valid
+    if density_bake is None:
+        return None
+    if state != density_bake_state:
+        reason = bake_mismatch(density_bake_meta, state)
+        if reason:
+            print(f"Density bake ignored: {reason}")
+        density_bake_state = state
+        density_bake_valid = reason is None
+    if not density_bake_valid:
+        return None
+    k = frame - density_bake_start
+    if not 0 <= k < density_bake.shape[0]:
+        return None
+    checks = density_bake_meta.get("particle_checks")
+    if checks is not None and checks[k] != check:
+        # Частицы перезапечены после запечки плотности: она не подходит ни к одному кадру
+        print(f"Density bake ignored: particles on frame {frame} differ from the bake")
+        density_bake_valid = False
+        return None
+    return density_bake[k]
+
+def rna_fingerprint(data):
+    # crc32 значений всех простых свойств RNA-структуры (настройки частиц, кеш частиц);
+    # не hash(), чтобы отпечаток совпадал между запусками Блендера. Флаги состояния кеша
+    # не входят: is_outdated ставится, например, при анимации эмиттера после запечки
+    values = []
+    for prop in data.bl_rna.properties:
+        if (prop.type in {'POINTER', 'COLLECTION'}
+                or prop.identifier in {'rna_type', 'info', 'is_outdated', 'is_frame_skip'}):
+            continue
+        value = getattr(data, prop.identifier)
+        if prop.type == 'ENUM' and prop.is_enum_flag:
+            value = tuple(sorted(value))
+        elif getattr(prop, "array_length", 0) > 0:
+            value = np.array(value).tobytes()
+        values.append(value)
+    return zlib.crc32(repr(values).encode())
+
+def particle_state():
+    # Отпечаток симуляции частиц без номера кадра: системы, их настройки и кеши, настройки
+    # столкновений и полей эмиттеров, коллайдеров и полей. Положения объектов сюда не входят:
+    # анимированные меняли бы отпечаток каждый кадр. Перезапечку после их сдвига, как и
+    # любую другую, ловит проверка координат частиц по кадрам (particle_check). Настройки
+    # поля без силы (type 'NONE') не входят: его seed Блендер выбирает заново в каждом сеансе
+    emitters = emitter_objects()
+    if not emitters:
+        return None
+    systems = [ob.particle_systems.active for ob in emitters]
+    objects = tuple((ob.name,
+                     rna_fingerprint(ob.collision) if ob.collision else 0,
+                     rna_fingerprint(ob.field) if ob.field and ob.field.type != 'NONE' else 0)
+                    for ob in simulation_objects())
+    return (tuple((rna_fingerprint(ps), rna_fingerprint(ps.settings), rna_fingerprint(ps.point_cache))
+                  for ps in systems),
+            objects)
+
+def frame_state():
+    # Всё, от чего зависит плотность кадра, кроме номера кадра: частицы (particle_state),
+    # меши приёмников и их положение, параметры ядра. Заодно сверяет приёмники (sync_receivers)
+    particles = particle_state()
+    if particles is None or not receivers_valid():
+        return None
+    sync_receivers()
+    return (particles,
+            receiver_key,
+            receiver_world.tobytes(),
+            tuple(kernel_params().values()))
+
+def density_params():
+    # Параметры ядра из констант скрипта для density_core.
+    # С LOD нормировка по максимуму делается после интерполяции на вершины (finish_lod)
+    normalization = 'none' if DENSITY_LOD and NORMALIZATION == 'max' else NORMALIZATION
+    params = dict(h=SMOOTHING_LENGTH, kernel=DENSITY_KERNEL, cutoff_factor=CUTOFF_FACTOR,
+                  normalization=normalization, reference=DENSITY_REFERENCE)
+    if DENSITY_MODE == 'large':
+        params['half'] = LARGE_HALF
+    return params
+
+def receiver_points():
+    # Точки, в которых считается ядро, и их габариты: вершины меша или узлы решётки LOD.
+    # БПФ-режим считает на CPU и берёт копию точек с хоста
+    if DENSITY_MODE == 'fft':
+        verts = lod_points if DENSITY_LOD else frame_buffers["verts"]
+    else:
+        verts = lod_nodes if DENSITY_LOD else receiver_verts
+    return verts, lod_bounds if DENSITY_LOD else receiver_bounds
+
+def finish_lod(out, density):
+    # Плотность в узлах LOD -> плотность в вершинах
+    density_lod.interpolate(out, lod_index, lod_weights, out=density)
+    if NORMALIZATION == 'max':
+        density_core.normalize_density(density)
+
+def record_particle_track():
+    # Источник частиц для фонового потока, чтобы он не трогал bpy. С дисковым кешем - отдельные
+    # читатели его файлов (у читателя кеш двух последних кадров, он не для двух потоков);
+    # иначе координаты и маски всех кадров сцены из запечённого кеша частиц (один проход
+    # frame_set). Привязан только к частицам: меши приёмников и параметры ядра на него не влияют
+    global particle_track, particle_track_state, prefetch_readers, track_recording
+    scene = bpy.context.scene
+    state = particle_state()
+    if state is None:
         return
-    
-    emitter = bpy.data.objects.get("Particle_Emitter")
-    if not emitter or not emitter.particle_systems:
+    particle_track = prefetch_readers = None
+    if point_cache_readers(state):
+        prefetch_readers = [PointCacheReader(r.directory, r.prefix, r.index) for r in point_caches]
+        particle_track_state = state
+        print(f"Particle track: point cache files in {point_cache_dir()}")
         return
-        
-    dg = bpy.context.evaluated_depsgraph_get()
-    ob = bpy.data.objects["Particle_Emitter"].evaluated_get(dg)
-    ps = ob.particle_systems.active
+    current = scene.frame_current
+    n_frames = scene.frame_end - scene.frame_start + 1
+    positions = alive = None
+    checks = np.zeros(n_frames, dtype=np.int64)
+    t0 = time.perf_counter()
+    track_recording = True
+    try:
+        for k, frame in enumerate(range(scene.frame_start, scene.frame_end + 1)):
+            scene.frame_set(frame)
+            pos, mask = gather_particles(frame)
+            if positions is None:
+                positions = np.zeros((n_frames, len(pos), 3), dtype=np.float32)
+                alive = np.zeros((n_frames, len(pos)), dtype=np.bool_)
+            positions[k] = pos
+            alive[k] = mask
+            checks[k] = particle_check(pos, mask)
+    finally:
+        track_recording = False
+    particle_track = (scene.frame_start, positions, alive, checks)
+    particle_track_state = state
+    print(f"Particle track: {len(positions)} frames, {positions.shape[1]} particles, "
+          f"{(positions.nbytes + alive.nbytes) / 2 ** 20:.0f} MB, {time.perf_counter() - t0:.2f} s")
+    scene.frame_set(current)
+
+def animation_playing():
+    return any(window.screen.is_animation_playing for window in bpy.context.window_manager.windows)
+
+def rerecord_particle_track():
+    # Таймер: траектория пишется через frame_set, поэтому не из обработчика кадра
+    # и не во время воспроизведения - тогда повтор через полсекунды
+    global track_scheduled
+    if animation_playing():
+        return 0.5
+    track_scheduled = False
+    record_particle_track()
+    return None
+
+def track_valid(frame, state, check):
+    # Источник частиц фонового потока записан для этой симуляции: тот же отпечаток частиц
+    # и, для траектории в памяти, те же частицы текущего кадра (перезапечка без смены настроек).
+    # Устаревший источник с дисковым кешем открывается заново сразу, траектория в памяти
+    # перезаписывается таймером, пока воспроизведение остановлено
+    global particle_track, track_scheduled
+    valid = particle_track_state == state[0]
+    if valid and particle_track is not None:
+        start, _, _, checks = particle_track
+        valid = not 0 <= frame - start < len(checks) or checks[frame - start] == check
+    if valid:
+        return True
+    if point_caches:
+        record_particle_track()
+        return prefetch_readers is not None
+    if not track_scheduled:
+        print("Particle track is out of date, prefetch paused until it is re-recorded")
+        particle_track = None
+        track_scheduled = True
+        bpy.app.timers.register(rerecord_particle_track)
+    return False
+
+def track_frames(frame):
+    # Кадры для фонового расчёта: следующие за текущим, которые есть в траектории
+    # или в файлах дискового кеша и ещё не в кеше плотности
+    if prefetch_readers:
+        first = min(int(r.frames[0]) for r in prefetch_readers)
+        last = max(int(r.frames[-1]) for r in prefetch_readers)
+    elif particle_track is not None:
+        first = particle_track[0]
+        last = first + len(particle_track[1]) - 1
+    else:
+        return []
+    return [f for f in range(frame + 1, frame + 1 + ASYNC_DEPTH)
+            if first <= f <= last and f not in frame_cache.frames]
+
+def prefetch_particles(frame, track, readers):
+    # Частицы кадра для фонового потока и их particle_check: из траектории или из файлов кеша
+    if readers is None:
+        start, positions, alive, checks = track
+        return positions[frame - start], alive[frame - start], checks[frame - start]
+    n = sum(len(reader) for reader in readers)
+    positions = prefetch_buffers.get("positions")
+    if positions is None or len(positions) != n:
+        positions = prefetch_buffers["positions"] = np.empty((n, 3), dtype=np.float32)
+        prefetch_buffers["alive"] = np.empty(n, dtype=np.bool_)
+    alive = prefetch_buffers["alive"]
+    offset = 0
+    for reader in readers:
+        reader.read(frame, positions[offset:offset + len(reader)], alive[offset:offset + len(reader)])
+        offset += len(reader)
+    return positions, alive, particle_check(positions, alive)
+
+def prefetch_job():
+    # Расчёт кадра для фонового потока: bpy не читается, вершины и матрица берутся
+    # из глобальных буферов под density_lock. Возвращает плотность и particle_check
+    # частиц, по которым она посчитана
+    params = density_params()
+    track, readers = particle_track, prefetch_readers
+
+    def job(frame, density):
+        positions, alive, check = prefetch_particles(frame, track, readers)
+        n_verts = len(frame_buffers["verts"])
+        if density is None or len(density) != n_verts:
+            density = np.empty(n_verts, dtype=np.float32)
+        verts, bounds = receiver_points()
+        world = receiver_world
+        out = np.empty(verts.shape[0], dtype=np.float32) if DENSITY_LOD else density
+        density_core.compute_density(verts, positions[alive], world=world, bounds=bounds,
+                                     mode=DENSITY_MODE, out=out, **params)
+        if DENSITY_LOD:
+            finish_lod(out, density)
+        return density, check
+    return job
+
+def incremental_enabled():
+    # Инкрементальный режим использует обрезанное ядро 'grid' и несовместим с проверкой точности
+    return INCREMENTAL_UPDATES and DENSITY_MODE == 'grid' and not CHECK_ACCURACY
+
+def frame_density(state=None, particles=None):
+    # Считает плотность на цилиндре для текущего состояния сцены.
+    # Возвращает буфер frame_buffer("density") или None, если объектов нет.
+    # state - отпечаток из frame_state() этого кадра (приёмники им уже сверены),
+    # particles - частицы из current_particles(), если они уже прочитаны
+    if state is None:
+        state = frame_state()
+        if state is None:
+            return None
+    if particles is None:
+        particles = current_particles(state[0])
+        if particles is None:
+            return None
+        if timer:
+            timer.lap("particles")
 
    
-    particles = ps.particles
-    part_data = np.empty((PARTICLE_COUNT, 3), dtype=np.float32)
-    for i in range(PARTICLE_COUNT):
-        p = particles[i]    
-    
+    # Все чтения и записи идут пакетно через foreach_get/foreach_set в заранее
+    # выделенные буферы: число вызовов Python не зависит от числа частиц и вершин.
+    # Считаются только живые частицы, их число меняется от кадра к кадру
+    scene = bpy.context.scene
+    use_incremental = incremental_enabled()
+    positions, alive = particles
+    if not use_incremental:
+        part_data = compact_particles(positions, alive)
     
-    for i, p in enumerate(particles):
-        part_data[i] = p.location
-    
-    
-    verts = np.empty((len(cylinder_obj.data.vertices), 3), dtype=np.float32)
-    cylinder_obj.data.vertices.foreach_get("co", verts.ravel())
-    density = np.empty(len(cylinder_obj.data.vertices), dtype=np.float32)
+    if DENSITY_LOD:
+        sync_lod()
+    verts, bounds = receiver_points()
+    # Поворот цилиндра из main() и любые другие трансформации объекта
+    # применяются в ядре через matrix_world (для нескольких приёмников - уже в буфере)
+    world = receiver_world
+    density = frame_buffer("density", (len(frame_buffers["verts"]),))
+    out = frame_buffer("lod_density", (verts.shape[0],)) if DENSITY_LOD else density
+    if timer:
+        timer.lap("receiver")
 
     """ frame = int(bpy.context.scene.frame_current)
     j = frame % len(verts)
@@ -228,16 +833,23 @@ def update_density(scene):
     print(f"Vertex {j}: pos=({verts[j][0]},{verts[j][1]}, {verts[j][2]})\n") """
     
     
-    for i in range(verts.shape[0]): #Обмен координат Х и Z после ротации цилиндра
-        x = verts[i][2]
-        verts[i][2] = -verts[i][0]
-        #verts[i][1] = -verts[i][1]
-        verts[i][0] = x
-
-    
-
-    update_particles(part_data)
-    calculate_density(verts, density)
+    params = density_params()
+    if use_incremental:
+        # Отпечаток сцены сбрасывает инкрементальное состояние при перезапечке и смене параметров
+        incremental.update(scene.frame_current, verts, positions, alive, world=world, bounds=bounds,
+                           key=state, out=out, **params)
+    else:
+        if CHECK_ACCURACY:
+            density_core.check_density_accuracy(verts, part_data, world=world, bounds=bounds,
+                                                mode=DENSITY_MODE, **params)
+        density_core.compute_density(verts, part_data, world=world, bounds=bounds,
+                                     mode=DENSITY_MODE, out=out, **params)
+    if timer:
+        timer.lap("density")
+    if DENSITY_LOD:
+        finish_lod(out, density)
+        if timer:
+            timer.lap("lod")
     
     """ print(f"Vertex {j}: pos=({verts[j][0]},{verts[j][1]}, {verts[j][2]})\n")
     print(f"location= {verts[frame % len(verts)]} frame = {frame}\n")
@@ -247,19 +859,168 @@ def update_density(scene):
         bpy.ops.mesh.primitive_cylinder_add(location=verts[frame % len(verts)])
     
     print(f"Exit\n") """
-    # Обновляем атрибут
-    density_attr = cylinder_obj.data.attributes["density"]
-    for i, val in enumerate(density):
-        density_attr.data[i].value = val
+    return density
+
+def frame_particles(frame=None):
+    # Копия живых частиц кадра, по умолчанию текущего (для пакетного расчёта, буферы кадра
+    # переиспользуются). С дисковым кешем кадр читается из файлов, frame_set не нужен
+    frame = bpy.context.scene.frame_current_final if frame is None else frame
+    return alive_particles(frame).copy()
+
+def batch_density(frames, out=None):
+    # Плотность нескольких кадров одним запуском ядра: frames - живые частицы кадров
+    # (frame_particles), результат - (кадры, вершины). Без инкрементального режима
+    with density_lock:
+        sync_receivers()
+        if DENSITY_LOD:
+            sync_lod()
+        verts, bounds = receiver_points()
+        world = receiver_world
+        if out is None:
+            out = np.empty((len(frames), len(frame_buffers["verts"])), dtype=np.float32)
+        nodes = np.empty((len(frames), verts.shape[0]), dtype=np.float32) if DENSITY_LOD else out
+        density_core.compute_density_batch(verts, frames, world=world, bounds=bounds, mode=DENSITY_MODE,
+                                           out=nodes, **density_params())
+        if DENSITY_LOD:
+            for k in range(len(frames)):
+                finish_lod(nodes[k], out[k])
+    return out
+
+def tune_density():
+    # Подставляет подобранные под машину параметры вместо констант скрипта
+    global DENSITY_MODE, LARGE_HALF, BATCH_FRAMES, receiver_verts, receiver_key, lod_key
+    emitters = emitter_objects()
+    if not receivers_valid() or not emitters:
+        return
+    with density_lock:
+        sync_receivers()
+        verts, bounds = frame_buffers["verts"], receiver_bounds
+        if DENSITY_LOD:
+            sync_lod()
+            verts, bounds = lod_points, lod_bounds
+        count = sum(ob.particle_systems.active.settings.count for ob in emitters)
+        # 'fft' считает только один цилиндр и только в его вершинах
+        config = density_tune.tuned_config(verts, count, SMOOTHING_LENGTH, receiver_world, bounds, DENSITY_KERNEL,
+                                           CUTOFF_FACTOR, path=TUNE_PATH, fft=len(receiver_objs) == 1 and not DENSITY_LOD,
+                                           threads=TUNE_THREADS, arch=TAICHI_ARCH)
+        if density_tune.apply(config, TAICHI_ARCH, debug=TAICHI_DEBUG, offline_cache=TAICHI_OFFLINE_CACHE,
+                              kernel_profiler=TIMING and TIMING_KERNEL_PROFILER):
+            # Taichi перезапущен: буферы на устройстве создаются заново
+            receiver_verts = receiver_key = lod_key = None
+            incremental.reset()
+    DENSITY_MODE = config["mode"]
+    LARGE_HALF = config.get("half", LARGE_HALF)
+    BATCH_FRAMES = config["batch"]
+
+def warm_up_density():
+    # Компилирует ядра под реальные размеры меша и число частиц при загрузке,
+    # чтобы первый вызов frame_change_pre не подвешивал вьюпорт
+    emitters = emitter_objects()
+    if not receivers_valid() or not emitters:
+        return
+    verts = sync_receivers()
+    bounds = receiver_bounds
+    if DENSITY_LOD:
+        verts = sync_lod()
+        bounds = lod_bounds
+    world = receiver_world
+    count = sum(ob.particle_systems.active.settings.count for ob in emitters)
+    modes = (DENSITY_MODE, 'brute') if CHECK_ACCURACY else (DENSITY_MODE,)
+    if incremental_enabled():
+        modes = ('incremental',)
+    params = density_params()
+    elapsed = density_core.warm_up(verts, count, params.pop('h'), world, bounds, modes, **params)
+    print(f"Density kernels warmed up ({verts.shape[0]} vertices, {count} particles): {elapsed * 1000:.0f} ms")
+
+def update_density(scene):
+    global first_frame_reported
+    
+    # Проверяем, что объекты существуют
+    if not receivers_valid() or track_recording:
+        return
+    
+    # Запечённый кадр просто копируется из memmap, затем смотрим кеш, иначе считаем на лету
+    frame = scene.frame_current
+    if timer:
+        timer.begin(frame)
+    prefetched = None
+    # В frame_change_pre depsgraph ещё не вычислен для нового кадра: у анимированных эмиттеров
+    # и приёмников частицы и matrix_world были бы с прошлого кадра, и particle_check не совпал
+    # бы ни с запечкой, ни с кешем
+    bpy.context.evaluated_depsgraph_get().update()
+    state = frame_state()
+    if state is None:
+        return
+    # Частицы кадра читаются и для запечки, и для кеша: их crc32 ловит перезапечку
+    particles = current_particles(state[0])
+    check = particle_check(*particles)
+    if timer:
+        timer.lap("particles")
+    density = baked_density(frame, state, check)
+    if density is None:
+        density = frame_cache.get(frame, state, check)
+        if density is None and prefetcher:
+            # Кадр, посчитанный в фоне, пока показывался предыдущий, по тем же частицам
+            prefetched = density = prefetcher.take(frame, state, check)
+            if density is not None:
+                frame_cache.put(frame, state, density, check)
+        if timer:
+            timer.lap("cache")
+        if density is None:
+            t0 = time.perf_counter()
+            with density_lock:
+                density = frame_density(state, particles)
+            frame_cache.put(frame, state, density, check)
+            if not first_frame_reported:
+                print(f"First density frame: {(time.perf_counter() - t0) * 1000:.0f} ms")
+                first_frame_reported = True
+        if prefetcher and track_valid(frame, state, check):
+            frames = track_frames(frame)
+            if frames:
+                # Приёмники уже сверены в frame_state(); замок - только если меняется решётка LOD
+                if DENSITY_LOD:
+                    sync_lod()
+                prefetcher.request(frames, state, prefetch_job())
+        if frame == scene.frame_end:
+            print(frame_cache.report())
+            if prefetcher:
+                print(prefetcher.report())
     
-    cylinder_obj.data.update()
+    # Обновляем атрибут: у каждого приёмника свой срез общего буфера
+    offsets = np.cumsum([0] + [len(obj.data.vertices) for obj in receiver_objs])
+    for obj, a, b in zip(receiver_objs, offsets[:-1], offsets[1:]):
+        obj.data.attributes["density"].data.foreach_set("value", density[a:b])
+    if prefetched is not None:
+        prefetcher.release(prefetched)
+    if timer:
+        timer.lap("write")
+    if density_core.TRACE:
+        # Записи фоновых кадров попадают в строку кадра, на котором забраны
+        with density_lock:
+            density_core.dump_trace(density_bake_file(TRACE_LOG_PATH), frame)
+    
+    for obj in receiver_objs:
+        obj.data.update()
+    if timer:
+        timer.lap("mesh_update")
+        timer.end()
+        if frame == scene.frame_end:
+            print(timer.report())
+            timer.dump(density_bake_file(TIMING_DUMP_PATH))
 
 
     
 
 
-def main():
+def main(setup_visualization=None, cube_location=(0, 0, -2.55), camera_location=(-2.97332, -63.2669, 3.56712)):
+    # Параметры позволяют вариантам сцены (emitube.py) переиспользовать main со своим материалом и раскладкой
+    global timer, prefetcher
+    setup_visualization = setup_visualization or setup_density_visualization
     clear_scene()
+    timer = frame_timing.FrameTimer(TIMING_FRAMES, TIMING_KERNEL_PROFILER) if TIMING else None
+    if prefetcher:
+        prefetcher.stop()
+    prefetcher = DensityPrefetcher(ASYNC_DEPTH, density_lock) if ASYNC_PREFETCH else None
 
 
     # Удаляем старые обработчики перед запуском
@@ -271,25 +1032,17 @@ def main():
 
     #bpy.context.window.workspace = bpy.data.workspaces["Скриптинг"]
     # Создаем объекты
-    cylinder = create_hollow_cylinder(CYLINDER_RADIUS, CYLINDER_HEIGHT)
-    bpy.ops.transform.rotate(value=math.pi/2.0, orient_axis='Y', orient_type='GLOBAL', orient_matrix=((1, 0, 0), (0, 1, 0), (0, 0, 1)), orient_matrix_type='GLOBAL', constraint_axis=(False, True, False), mirror=False, use_proportional_edit=False, proportional_edit_falloff='SMOOTH', proportional_size=1, use_proportional_connected=False, use_proportional_projected=False, snap=False, snap_elements={'INCREMENT'}, use_snap_project=False, snap_target='CLOSEST', use_snap_self=True, use_snap_edit=True, use_snap_nonedit=True, use_snap_selectable=False)
-    
-    
-    
-    mod = cylinder.modifiers.new(name="Subdivision", type='SUBSURF')
-    mod.levels = 2  # Количество уровней подразделения (в режиме просмотра)
-    mod.render_levels = 2  # Количество уровней при рендере
-
-    # Применяем модификатор (если нужно сразу получить результат)
-    bpy.ops.object.modifier_apply(modifier="Subdivision")
+    # Сцена строится из массивов без операторов, кроме запечки кеша частиц
+    t0 = time.perf_counter()
+    create_hollow_cylinder(CYLINDER_RADIUS, CYLINDER_HEIGHT, rotation=(0, math.pi/2.0, 0))
 
-    bpy.ops.mesh.primitive_cube_add(size=2, enter_editmode=False, align='WORLD', location=(0, 0, -2.55), scale=(1, 5, 1))
-    cube = bpy.context.object
+    cube_verts, cube_faces = scene_mesh.box(2)
+    cube = add_mesh_object("Collision_Cube", cube_verts, cube_faces, location=cube_location, scale=(1, 5, 1))
     cube.modifiers.new(name="Collision", type='COLLISION')
 
-    bpy.ops.mesh.primitive_plane_add(size=CYLINDER_RADIUS, rotation=(math.pi/2.0, 0, math.pi/2.0), location=(-CYLINDER_HEIGHT/2 - 0.5, 0, 0))
-    emitter = bpy.context.object
-    emitter.name = "Particle_Emitter"
+    plane_verts, plane_faces = scene_mesh.plane(CYLINDER_RADIUS)
+    emitter = add_mesh_object("Particle_Emitter", plane_verts, plane_faces,
+                              location=(-CYLINDER_HEIGHT/2 - 0.5, 0, 0), rotation=(math.pi/2.0, 0, math.pi/2.0))
     
     print(f"Emitter location: {emitter.location}")  # Где находится эмиттер?
     psys = emitter.modifiers.new(name="Particles", type='PARTICLE_SYSTEM').particle_system
@@ -300,16 +1053,31 @@ def main():
     settings.physics_type = 'NEWTON'
     settings.normal_factor = 10
     settings.frame_start = 1
+    if POINT_CACHE_DISK and not bpy.data.filepath:
+        # Блендер включает дисковый кеш только у сохранённого .blend, иначе флаг не ставится
+        print("POINT_CACHE_DISK: the .blend is not saved, particles are cached in memory and read via depsgraph")
+    elif POINT_CACHE_DISK:
+        # Без сжатия файлы кадров читаются через memmap
+        psys.point_cache.use_disk_cache = True
+        psys.point_cache.compression = 'NO'
+
+    print(f"Scene built in {(time.perf_counter() - t0) * 1000:.0f} ms")
 
     bpy.ops.ptcache.bake_all(bake=True)
     #bpy.context.scene.frame_set(int(settings.frame_start))
-    setup_density_visualization(cylinder)
+    setup_visualization([bpy.data.objects[name] for name in RECEIVERS if name in bpy.data.objects])
+    load_density_bake()
+    if AUTO_TUNE:
+        tune_density()
+    warm_up_density()
+    if prefetcher:
+        record_particle_track()
+        prefetcher.start()
    
     # Камера и свет
-    bpy.ops.object.camera_add(location=(-2.97332, -63.2669, 3.56712), rotation=(math.radians(82.8666), math.radians(-0.000004), math.radians(-3.26668))) #location=(-2.97332, -33.2669, 3.56712)
-    bpy.context.scene.camera = bpy.context.object
+    bpy.context.scene.camera = add_object("Camera", bpy.data.cameras.new("Camera"), location=camera_location, rotation=(math.radians(82.8666), math.radians(-0.000004), math.radians(-3.26668))) #location=(-2.97332, -33.2669, 3.56712)
     
-    bpy.ops.object.light_add(type='SUN', location=(15, -15, 20))
+    add_object("Sun", bpy.data.lights.new("Sun", type='SUN'), location=(15, -15, 20))
 
     # Добавляем новый обработчик
     bpy.app.handlers.frame_change_pre.append(update_density)
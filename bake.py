@@ -0,0 +1,117 @@
+# Офлайн-запечка плотности по кадрам в memmap .npy (кадры x вершины, float32).
+# Рядом пишется <файл>.json с диапазоном кадров, параметрами ядра, отпечатком сцены и crc32
+# частиц каждого кадра; update_density подхватывает запечку через load_density_bake и на смене
+# кадра только копирует строку из memmap, если всё это совпадает с текущей сценой.
+#
+# Запуск без интерфейса:
+#   blender --background проект.blend --python bake.py -- --start 1 --end 250
+#   blender --background --python bake.py -- --script emitube --out density_bake.npy
+# Если в сцене нет эмиттера, сцена сначала строится через main() выбранного скрипта.
+# С --out *.dens кадры пишутся потоком в квантованный формат density_store (--bits, --delta).
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from density_store import DensityWriter
+
+
+def parse_args(argv):
+    # Аргументы скрипта идут после "--", всё до него забирает сам Blender
+    argv = argv[argv.index("--") + 1:] if "--" in argv else []
+    parser = argparse.ArgumentParser(prog="bake.py", description="Запечка плотности частиц на цилиндре")
+    parser.add_argument("--script", default="actualcode", help="модуль сцены (actualcode или emitube)")
+    parser.add_argument("--start", type=int, default=None, help="первый кадр (по умолчанию начало сцены)")
+    parser.add_argument("--end", type=int, default=None, help="последний кадр (по умолчанию конец сцены)")
+    parser.add_argument("--out", default=None, help="файл .npy или .dens (по умолчанию DENSITY_BAKE_PATH скрипта)")
+    parser.add_argument("--bits", type=int, default=8, choices=(8, 16), help="квантование для .dens")
+    parser.add_argument("--delta", action="store_true", help="дельты между кадрами для .dens")
+    parser.add_argument("--batch", type=int, default=None, help="кадров в пакете (по умолчанию BATCH_FRAMES)")
+    return parser.parse_args(argv)
+
+
+def bake_density(adapter, frame_start, frame_end, path, bits=8, delta=False, batch=None):
+    scene = bpy.context.scene
+    
+    # Обработчик кадра не нужен: плотность считаем здесь сами
+    for handler in bpy.app.handlers.frame_change_pre[:]:
+        if "update_density" in handler.__name__:
+            bpy.app.handlers.frame_change_pre.remove(handler)
+    
+    if not adapter.receiver_objs:
+        adapter.set_receivers([bpy.data.objects[name] for name in adapter.RECEIVERS if name in bpy.data.objects])
+        # Сцена из .blend, main() не запускался: подобранные параметры берём здесь
+        if adapter.AUTO_TUNE:
+            adapter.tune_density()
+    if not all(ps.point_cache.is_baked for ob in adapter.emitter_objects() for ps in ob.particle_systems):
+        bpy.ops.ptcache.bake_all(bake=True)
+    # С POINT_CACHE_DISK частицы кадров читаются из файлов кеша, без frame_set
+    adapter.point_cache_readers(adapter.particle_state())
+    
+    # Строка запечки - вершины всех приёмников подряд, в порядке RECEIVERS
+    n_frames = frame_end - frame_start + 1
+    n_verts = sum(len(obj.data.vertices) for obj in adapter.receiver_objs)
+    if path.endswith(".dens"):
+        out = DensityWriter(path, n_verts, frame_start, bits, delta)
+    else:
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_frames, n_verts))
+    
+    # Частицы собираются по batch кадров, плотность пакета считается одним запуском ядра
+    batch = batch or adapter.BATCH_FRAMES
+    checks = []
+    t0 = time.perf_counter()
+    for k0 in range(0, n_frames, batch):
+        frames = []
+        for k in range(k0, min(k0 + batch, n_frames)):
+            if not adapter.point_caches:
+                scene.frame_set(frame_start + k)
+            positions, alive = adapter.gather_particles(frame_start + k)
+            checks.append(adapter.particle_check(positions, alive))
+            frames.append(adapter.compact_particles(positions, alive).copy())
+        density = adapter.batch_density(frames)
+        if path.endswith(".dens"):
+            for row in density:
+                out.write(row)
+        else:
+            out[k0:k0 + len(density)] = density
+    if path.endswith(".dens"):
+        out.close()
+    else:
+        out.flush()
+    del out
+    elapsed = time.perf_counter() - t0
+    
+    # Метаданные пишем последними: незаконченная запечка без .json не загрузится
+    with open(path + ".json", "w") as f:
+        json.dump({"frame_start": frame_start, "frame_end": frame_end, "vertices": n_verts,
+                   "objects": [obj.name for obj in adapter.receiver_objs],
+                   "smoothing_length": adapter.SMOOTHING_LENGTH,
+                   "kernel": adapter.kernel_params(), "fingerprint": adapter.bake_fingerprint(adapter.particle_state()),
+                   "particle_checks": checks, "seconds": elapsed}, f, indent=2)
+    print(f"Baked frames {frame_start}-{frame_end} ({n_verts} vertices) to {path}: "
+          f"{elapsed:.2f} s, {n_frames / max(elapsed, 1e-9):.1f} frames/s")
+
+
+def main():
+    args = parse_args(sys.argv)
+    # Импорт варианта сцены применяет его настройки к actualcode, сам расчёт всегда в actualcode
+    scene_mod = importlib.import_module(args.script)
+    import actualcode
+    if not actualcode.emitter_objects():
+        scene_mod.main()
+    
+    scene = bpy.context.scene
+    frame_start = args.start if args.start is not None else scene.frame_start
+    frame_end = args.end if args.end is not None else scene.frame_end
+    path = actualcode.density_bake_file(args.out or actualcode.DENSITY_BAKE_PATH)
+    bake_density(actualcode, frame_start, frame_end, path, args.bits, args.delta, args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Параллельная запечка плотности: диапазон кадров делится на N кусков, каждый кусок
+# печёт отдельный Blender без интерфейса (bake.py) в свой .npy, затем куски сливаются
+# в один файл запечки того же формата, что пишет bake.py: memmap .npy или, для --out *.dens,
+# квантованный density_store (--bits, --delta), и .json.
+# Кадры независимы (частицы берутся из кеша частиц), поэтому работа делится без обмена данными.
+# Без --blend каждый процесс строит сцену скриптом и сам запекает кеш частиц (bake_all
+# на весь диапазон сцены) - эта работа повторяется в каждом процессе. С --blend, где кеш
+# частиц уже запечён, процессы только считают плотность.
+#
+# Запускается обычным Python, не из Blender:
+#   python bake_parallel.py --blender "путь к blender" --blend проект.blend --start 1 --end 250 --workers 4
+#   python bake_parallel.py --blender blender --script emitube --workers 1,2,4,8
+# Во втором случае запечка повторяется для каждого числа процессов и печатается таблица
+# ускорения; в файле остаётся результат последнего прогона.
+#
+# Потоки Taichi на CPU делятся между процессами (TI_CPU_MAX_NUM_THREADS), чтобы N процессов
+# не запускали по пулу на все ядра каждый. При расчёте на GPU все процессы делят одну карту.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from density_store import DensityWriter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="bake_parallel.py", description="Параллельная запечка плотности")
+    parser.add_argument("--blender", default="blender", help="исполняемый файл Blender")
+    parser.add_argument("--blend", default=None,
+                        help="файл .blend (по умолчанию сцена и кеш частиц строятся скриптом в каждом процессе)")
+    parser.add_argument("--script", default="actualcode", help="модуль сцены (actualcode или emitube)")
+    parser.add_argument("--start", type=int, required=True, help="первый кадр")
+    parser.add_argument("--end", type=int, required=True, help="последний кадр")
+    parser.add_argument("--out", default="density_bake.npy", help="итоговый файл .npy или .dens")
+    parser.add_argument("--bits", type=int, default=8, choices=(8, 16), help="квантование для .dens")
+    parser.add_argument("--delta", action="store_true", help="дельты между кадрами для .dens")
+    parser.add_argument("--workers", default=str(os.cpu_count() or 1),
+                        help="число процессов или список через запятую для замера масштабирования")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="потоков Taichi на процесс (по умолчанию ядра / процессы)")
+    args = parser.parse_args(argv)
+    # Формат проверяется до запуска процессов, а не при слиянии после них
+    if not args.out.endswith((".npy", ".dens")):
+        parser.error(f"--out: нужен файл .npy или .dens, не {args.out}")
+    return args
+
+
+def split_frames(frame_start, frame_end, n):
+    # Непрерывные куски почти равной длины, пустые куски отбрасываются
+    bounds = np.linspace(frame_start, frame_end + 1, n + 1).round().astype(int)
+    return [(int(a), int(b) - 1) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def worker_command(args, start, end, path):
+    cmd = [args.blender, "--background"]
+    if args.blend:
+        cmd.append(args.blend)
+    cmd += ["--python", os.path.join(HERE, "bake.py"), "--",
+            "--script", args.script, "--start", str(start), "--end", str(end), "--out", path]
+    return cmd
+
+
+def run_workers(args, n_workers, path):
+    # Запускает процессы и ждёт их; возвращает пути кусков и время по часам
+    chunks = split_frames(args.start, args.end, n_workers)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // len(chunks))
+    env = dict(os.environ, TI_CPU_MAX_NUM_THREADS=str(threads), OMP_NUM_THREADS=str(threads))
+    # Куски всегда .npy: их читает merge_parts, формат итога выбирается при слиянии
+    base = os.path.splitext(path)[0]
+    parts = [f"{base}.part{i}.npy" for i in range(len(chunks))]
+    t0 = time.perf_counter()
+    procs = [subprocess.Popen(worker_command(args, start, end, part), env=env, cwd=HERE)
+             for (start, end), part in zip(chunks, parts)]
+    failed = [p.args for p in procs if p.wait() != 0]
+    elapsed = time.perf_counter() - t0
+    if failed:
+        raise RuntimeError(f"Запечка не удалась: {failed}")
+    return parts, threads, elapsed
+
+
+def merge_parts(parts, path, bits=8, delta=False):
+    # Сливает куски в один файл запечки; .json пишется последним, как в bake.py
+    metas = []
+    for part in parts:
+        with open(part + ".json") as f:
+            metas.append(json.load(f))
+    n_verts = metas[0]["vertices"]
+    if any(m["vertices"] != n_verts for m in metas):
+        raise RuntimeError("Куски запечены на разных мешах")
+    if any(m.get("kernel") != metas[0].get("kernel") or m.get("fingerprint") != metas[0].get("fingerprint")
+           for m in metas):
+        raise RuntimeError("Куски запечены с разными параметрами ядра или на разных сценах")
+    frame_start, frame_end = metas[0]["frame_start"], metas[-1]["frame_end"]
+    if path.endswith(".dens"):
+        # Куски идут подряд по кадрам, поэтому строки пишутся потоком
+        out = DensityWriter(path, n_verts, frame_start, bits, delta)
+    else:
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                        shape=(frame_end - frame_start + 1, n_verts))
+    for part, meta in zip(parts, metas):
+        k = meta["frame_start"] - frame_start
+        data = np.load(part, mmap_mode='r')
+        if path.endswith(".dens"):
+            for row in data:
+                out.write(row)
+        else:
+            out[k:k + len(data)] = data
+        del data
+    if path.endswith(".dens"):
+        out.close()
+    else:
+        out.flush()
+    del out
+    meta = dict(metas[0], frame_start=frame_start, frame_end=frame_end,
+                seconds=max(m.get("seconds", 0.0) for m in metas))
+    if all("particle_checks" in m for m in metas):
+        meta["particle_checks"] = [c for m in metas for c in m["particle_checks"]]
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+    for part in parts:
+        os.remove(part + ".json")
+        os.remove(part)
+    return meta
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    path = os.path.abspath(args.out)
+    n_frames = args.end - args.start + 1
+    rows = []
+    for n in [int(w) for w in args.workers.split(",")]:
+        parts, threads, elapsed = run_workers(args, n, path)
+        meta = merge_parts(parts, path, args.bits, args.delta)
+        # По часам - с запуском Blender и построением сцены, расчёт - по самому медленному процессу
+        rows.append((len(parts), threads, n_frames / elapsed, n_frames / max(meta["seconds"], 1e-9)))
+        print(f"Baked frames {args.start}-{args.end} with {len(parts)} workers x {threads} threads "
+              f"to {path}: {elapsed:.2f} s")
+
+    base_wall, base_compute = rows[0][2], rows[0][3]
+    print("workers  threads  frames/s (wall)  speedup  frames/s (compute)  speedup")
+    for workers, threads, wall, compute in rows:
+        print(f"{workers:7d}  {threads:7d}  {wall:15.1f}  {wall / base_wall:7.2f}  "
+              f"{compute:18.1f}  {compute / base_compute:7.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# Бенчмарк расчёта плотности без Блендера: синтетический цилиндр как в main()
+# (R=3, H=15, 32 сегмента, подразделение уровня N) и облако частиц, время загрузки
+# частиц на устройство и compute_density. Каждая конфигурация Taichi (arch, число потоков CPU)
+# запускается в отдельном процессе с выключенным офлайн-кешем, поэтому время первого вызова
+# включает JIT, а устойчивое время - медиана следующих повторов. Результат сверяется с
+# эталоном на numpy по выборке вершин. Итог пишется в JSON для сравнения между коммитами.
+#
+#   python benchmark.py
+#   python benchmark.py --particles 1000,100000 --levels 2,4 --arch cpu,vulkan --out bench.json
+#   python benchmark.py --threads 1,4,8 --modes grid --kernel wendland_c2
+#   python benchmark.py --particles 1000000 --levels 2,3 --modes large
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import scene_mesh
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CYLINDER_RADIUS = 3.0
+CYLINDER_HEIGHT = 15.0
+CYLINDER_SEGMENTS = 32  # как у primitive_cylinder_add
+REFERENCE_VERTICES = 256  # вершин в выборке для сверки с numpy
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Бенчмарк ядер плотности")
+    parser.add_argument("--particles", default="1000,10000,100000,1000000", help="числа частиц через запятую")
+    parser.add_argument("--levels", default="2,3,4", help="уровни подразделения цилиндра")
+    parser.add_argument("--arch", default="cpu", help="arch Taichi через запятую (cpu, cuda, vulkan)")
+    parser.add_argument("--threads", default="0", help="потоков CPU через запятую, 0 - все ядра")
+    parser.add_argument("--modes", default="grid,brute", help="режимы density_core через запятую")
+    parser.add_argument("--kernel", default="gaussian", help="ядро сглаживания")
+    parser.add_argument("--h", type=float, default=CYLINDER_RADIUS / 2, help="длина сглаживания")
+    parser.add_argument("--repeats", type=int, default=5, help="повторов для устойчивого времени")
+    parser.add_argument("--max-pairs", type=float, default=2e9,
+                        help="пропускать 'brute', если вершин x частиц больше")
+    parser.add_argument("--out", default="benchmark.json", help="файл результатов JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def int_list(text):
+    return [int(float(x)) for x in text.split(",") if x]
+
+
+def cylinder_vertices(level, radius=CYLINDER_RADIUS, height=CYLINDER_HEIGHT, segments=CYLINDER_SEGMENTS):
+    # Та же сетка, что строит actualcode.main() (scene_mesh.open_cylinder)
+    return scene_mesh.open_cylinder(radius, height, segments, level)[0]
+
+
+def particle_cloud(n, seed=0, radius=CYLINDER_RADIUS, height=CYLINDER_HEIGHT):
+    # Частицы летят вдоль оси цилиндра: равномерно по объёму с запасом по радиусу и торцам
+    rng = np.random.default_rng(seed)
+    r = 1.2 * radius * np.sqrt(rng.random(n))
+    theta = rng.uniform(0.0, 2.0 * np.pi, n)
+    z = rng.uniform(-height / 2 - 1.0, height / 2 + 1.0, n)
+    return np.stack([r * np.cos(theta), r * np.sin(theta), z], axis=1).astype(np.float32)
+
+
+def reference_density(vertices, particles, h, kernel, chunk=1 << 22):
+    # Эталон: ядро по всем парам на numpy, частицы по кускам, чтобы не съесть память
+    import density_core
+    shape = density_core.KERNELS[kernel][1]
+    result = np.zeros(len(vertices))
+    step = max(1, chunk // len(vertices))
+    for i in range(0, len(particles), step):
+        d = np.linalg.norm(vertices[:, None, :].astype(np.float64) - particles[None, i:i + step], axis=2)
+        result += shape(d / h).sum(axis=1)
+    return result
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def run_config(args, arch, threads):
+    # Один процесс - одна конфигурация Taichi; JIT меряется на холодном старте
+    import taichi as ti
+    import density_core
+    init_kw = {"cpu_max_num_threads": threads} if threads else {}
+    startup = density_core.init(arch=arch, offline_cache=False, **init_kw)
+    rows = []
+    compiled = set()
+    for level in int_list(args.levels):
+        vertices = cylinder_vertices(level)
+        sample = np.random.default_rng(1).choice(len(vertices), min(REFERENCE_VERTICES, len(vertices)), replace=False)
+        for n in int_list(args.particles):
+            particles = particle_cloud(n)
+            reference = reference_density(vertices[sample], particles, args.h, args.kernel)
+            out = np.empty(len(vertices), dtype=np.float32)
+
+            def upload():
+                density_core.upload_particles(particles)
+                ti.sync()
+
+            for mode in args.modes.split(","):
+                if mode == 'brute' and len(vertices) * n > args.max_pairs:
+                    continue
+
+                def compute():
+                    density_core.compute_density(vertices, particles, args.h, mode=mode, kernel=args.kernel,
+                                                 normalization='none', out=out)
+                    ti.sync()
+
+                # Первый вызов режима в процессе платит за компиляцию ядер
+                first = timed(compute)
+                steady = [timed(compute) for _ in range(args.repeats)]
+                upload_times = [timed(upload) for _ in range(args.repeats)]
+                err = np.abs(out[sample] - reference).max() / max(reference.max(), 1e-30)
+                rows.append({
+                    "arch": density_core.current_arch(), "threads": threads, "level": level,
+                    "vertices": len(vertices), "particles": n, "mode": mode, "kernel": args.kernel,
+                    "first_call_s": first, "includes_jit": mode not in compiled,
+                    "steady_median_s": float(np.median(steady)), "steady_min_s": float(np.min(steady)),
+                    "upload_median_s": float(np.median(upload_times)),
+                    "pairs_per_s": len(vertices) * n / max(float(np.median(steady)), 1e-12),
+                    "max_rel_error": float(err),
+                })
+                compiled.add(mode)
+                print(f"{rows[-1]['arch']:>6} t={threads:<3d} V={len(vertices):<7d} P={n:<8d} {mode:<6} "
+                      f"first {first * 1000:9.1f} ms  steady {rows[-1]['steady_median_s'] * 1000:9.2f} ms  "
+                      f"err {err:.2e}", file=sys.stderr)
+    return {"startup_s": startup, "rows": rows}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        # Дочерний процесс: вывод ядер и логов Taichi идёт в stdout, результат - последней строкой
+        result = run_config(args, args.arch, int_list(args.threads)[0])
+        print("\n" + json.dumps(result))
+        return
+
+    import taichi as ti
+    results = {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(), "numpy": np.__version__, "taichi": ti.__version__,
+               "machine": platform.machine(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+               "args": {k: v for k, v in vars(args).items() if k != "worker"}, "configs": []}
+    for arch in args.arch.split(","):
+        for threads in int_list(args.threads):
+            cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--arch", arch, "--threads", str(threads),
+                   "--particles", args.particles, "--levels", args.levels, "--modes", args.modes,
+                   "--kernel", args.kernel, "--h", str(args.h), "--repeats", str(args.repeats),
+                   "--max-pairs", str(args.max_pairs)]
+            proc = subprocess.run(cmd, cwd=HERE, stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                print(f"Benchmark config arch={arch} threads={threads} failed ({proc.returncode})")
+                continue
+            config = json.loads(proc.stdout.strip().splitlines()[-1])
+            config.update(arch=arch, threads=threads)
+            results["configs"].append(config)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
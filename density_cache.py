@@ -0,0 +1,87 @@
+# LRU-кеш массивов плотности в памяти процесса.
+# Ключ - (кадр, состояние), где состояние - всё, от чего зависит результат кадра:
+# отпечатки настроек и кеша частиц, меша, параметров ядра. При смене состояния
+# (другое h, правка меша, настройки частиц) кеш очищается целиком.
+# У кадра есть ещё проверка - отпечаток его входных данных (crc32 координат частиц кадра):
+# если при чтении кадра она не совпала с сохранённой, симуляция перезапечена, и устарели
+# все кадры, а не только этот.
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DensityCache:
+    def __init__(self, budget_mb=512):
+        self.budget = int(budget_mb * 1024 * 1024)  # байт
+        self.frames = OrderedDict()  # кадр -> массив, последний - самый свежий
+        self.checks = {}  # кадр -> проверка, с которой он посчитан
+        self.state = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def clear(self):
+        self.frames.clear()
+        self.checks.clear()
+        self.nbytes = 0
+
+    def sync_state(self, state):
+        # Состояние сцены поменялось - все закешированные кадры устарели
+        if state != self.state:
+            if self.frames:
+                self.invalidations += 1
+            self.clear()
+            self.state = state
+
+    def get(self, frame, state, check=None):
+        self.sync_state(state)
+        density = self.frames.get(frame)
+        if density is not None and self.checks.get(frame) != check:
+            # Частицы кадра уже другие - перезапечка
+            self.invalidations += 1
+            self.clear()
+            density = None
+        if density is None:
+            self.misses += 1
+            return None
+        self.frames.move_to_end(frame)
+        self.hits += 1
+        return density
+
+    def put(self, frame, state, density, check=None):
+        self.sync_state(state)
+        if density.nbytes > self.budget:
+            return
+        old = self.frames.pop(frame, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        density = np.array(density, dtype=np.float32, copy=True)
+        self.frames[frame] = density
+        self.checks[frame] = check
+        self.nbytes += density.nbytes
+        while self.nbytes > self.budget:
+            evicted_frame, evicted = self.frames.popitem(last=False)
+            del self.checks[evicted_frame]
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "frames": len(self.frames),
+            "megabytes": self.nbytes / (1024 * 1024),
+            "budget_mb": self.budget / (1024 * 1024),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def report(self):
+        s = self.stats()
+        return (f"Density cache: {s['frames']} frames, {s['megabytes']:.1f}/{s['budget_mb']:.0f} MB, "
+                f"hits {s['hits']}, misses {s['misses']} ({s['hit_rate']:.0%}), "
+                f"evictions {s['evictions']}, invalidations {s['invalidations']}")
@@ -0,0 +1,752 @@
+# Расчёт плотности частиц в вершинах меша без зависимости от Blender.
+# Нужны только numpy и taichi, поэтому модуль можно импортировать, тестировать
+# и профилировать вне Blender (например, на Taichi CPU бэкенде):
+#
+#   import density_core
+#   density_core.init(arch='cpu')
+#   density = density_core.compute_density(vertices, particles, h=1.5)
+#
+# actualcode.py только достаёт из сцены вершины, частицы и matrix_world и передаёт их сюда.
+import json
+import time
+
+import numpy as np
+import taichi as ti
+
+import density_fft
+
+MAX_GRID_CELLS = 1 << 18
+DENSITY_MODES = ('grid', 'brute', 'fft', 'large')
+NORMALIZATIONS = ('none', 'max', 'fixed')
+# Бэкенды Taichi по имени; недоступный бэкенд откатывается на следующий в списке
+ARCHES = {
+    'cpu': [ti.cpu],
+    'vulkan': [ti.vulkan, ti.cpu],
+    'cuda': [ti.cuda, ti.cpu],
+    'auto': [ti.cuda, ti.vulkan, ti.cpu],
+}
+
+# Ядра сглаживания: имя -> (радиус носителя в единицах h или None, форма ядра W(q), q = r / h).
+# Все ядра нормированы на W(0) = 1, как и исходный гаусс. Гаусс бесконечен и в режиме 'grid'
+# обрезается на cutoff_factor * h; остальные ядра имеют компактный носитель, поэтому
+# отсечение соседей по сетке для них точное
+KERNELS = {
+    'gaussian': (None, lambda q: np.exp(-0.5 * q * q)),
+    'cubic_spline': (2.0, lambda q: np.where(q < 1.0, 1.0 - 1.5 * q ** 2 + 0.75 * q ** 3,
+                                             0.25 * np.clip(2.0 - q, 0.0, None) ** 3)),
+    'wendland_c2': (2.0, lambda q: np.clip(1.0 - 0.5 * q, 0.0, None) ** 4 * (2.0 * q + 1.0)),
+    'poly6': (2.0, lambda q: np.clip(1.0 - 0.25 * q * q, 0.0, None) ** 3),
+}
+KERNEL_NAMES = tuple(KERNELS)
+# Ядро в режимах 'grid' и инкрементальном берётся из таблицы по квадрату расстояния
+# (без sqrt и exp во внутреннем цикле), LUT_SIZE + 1 узлов на [0, support^2]
+LUT_SIZE = 1024
+# Режим 'large' (1e5-1e6 частиц) считает частицы кусками по LARGE_CHUNK, координаты
+# на устройстве - три отдельных массива x, y, z (SoA) относительно угла своей ячейки,
+# в float16 (half=True) или float32; сумма в вершинах всегда во float32.
+# Память на частицу:
+#   устройство - 6 байт (float16) или 12 байт (float32), но только на частицы одного куска,
+#     плюс 4 байта на ячейку сетки (начала ячеек, до MAX_GRID_CELLS);
+#   хост, временно на кусок - около 100 байт (индексы ячеек и сортировки в int64,
+#     координаты относительно ячейки во float64);
+#   хост, на весь кадр - 12 байт входного массива (P, 3) float32; actualcode.py ещё
+#     держит около 22 байт на частицу при чтении из Блендера (координаты, время рождения
+#     и смерти, флаги) и 12 байт на копию живых частиц.
+# Итого при LARGE_CHUNK = 2^18 и 1e6 частиц: около 1.5 МБ (float16) на устройстве
+# и около 70 МБ на хосте. Ошибка float16 относительно ячейки - не больше cell * 2^-11
+LARGE_CHUNK = 1 << 18
+# Ячейка сетки режима 'large' - носитель / LARGE_CELL_SPLIT: вершина обходит ячейки, которые
+# пересекает шар носителя, а не куб 3x3x3 из ячеек размером с носитель (в ~6 раз больше объёма)
+LARGE_CELL_SPLIT = 4
+# block_dim параллельного цикла по вершинам в ядрах 'grid', 'large' и 'brute' (ti.loop_config),
+# 0 - значение Taichi по умолчанию. Передаётся в ядра шаблонным аргументом: на каждое значение
+# своя компиляция, перезапуск Taichi не нужен. Подбирается density_tune
+BLOCK_DIM = 0
+# Отладочная трассировка вместо print в ядрах (init(trace=True)): ядра кладут выборку значений
+# в буфер на устройстве - каждый TRACE_STRIDE-й элемент и элементы с номерами из TRACE_INDICES,
+# не больше TRACE_CAPACITY записей. Буфер забирается на хост раз в кадр (read_trace, dump_trace).
+# Строки (кадры пакетов) нумеруются подряд по всем вызовам с прошлого read_trace. Записи - плотность
+# до нормировки 'max': она делается отдельным проходом, и её множитель на строку пишется рядом.
+# При trace=False ветки трассировки выбрасываются при компиляции (ti.static), ядра те же, что
+# без неё. Настройки читаются при компиляции ядер, поэтому задаются до init
+TRACE = False
+TRACE_STRIDE = 1024
+TRACE_INDICES = ()
+TRACE_CAPACITY = 4096
+TRACE_SOURCES = ('particles', 'brute', 'grid', 'large', 'incremental')
+
+# Буферы на устройстве, переиспользуются между вызовами. Ёмкость растёт геометрически,
+# а фактическое число частиц передаётся в ядра, так что смена числа частиц
+# от кадра к кадру не требует ни перекомпиляции, ни новых выделений
+particles_pos = None  # ti.ndarray(vec3) с частицами текущего кадра
+cell_start = None  # ti.ndarray(i32), частицы ячейки c лежат в [cell_start[c], cell_start[c + 1])
+frame_start = None  # ti.ndarray(i32), частицы кадра k пакета лежат в [frame_start[k], frame_start[k + 1])
+density_max = None  # ti.ndarray(f32, 1) - результат редукции для нормировки 'max'
+soa_buffers = {}  # тип (ti.f16 или ti.f32) -> [x, y, z] куска частиц режима 'large'
+kernel_tables = {}  # (ядро, cutoff_factor) -> таблица ядра на устройстве
+# Буфер трассировки (поля, чтобы не менять сигнатуры ядер), создаётся в init(trace=True)
+trace_ids = None  # ti.Vector.field(3, i32): источник из TRACE_SOURCES, кадр пакета, номер элемента
+trace_values = None  # ti.Vector.field(4, f32): координаты и значение
+trace_count = None  # ti.field(i32, ()) - сколько записей хотели положить с прошлого read_trace
+trace_row0 = None  # ti.field(i32, ()) - номер первой строки текущего пакета
+trace_scales = []  # на строку: множитель нормировки 'max' после ядра (1.0 без неё)
+
+
+def init(arch='auto', debug=False, offline_cache=True, offline_cache_file_path=None, trace=None, **kwargs):
+    # Обёртка над ti.init. debug включает проверки границ и медленную кодогенерацию,
+    # поэтому по умолчанию выключен; offline_cache сохраняет скомпилированные ядра
+    # на диск, и следующий запуск не платит за JIT. Возвращает время старта в секундах.
+    # Повторный init (например, с другим числом потоков в density_tune) сбрасывает буферы.
+    # trace включает трассировку (None - оставить как было)
+    global particles_pos, cell_start, frame_start, density_max, soa_buffers, kernel_tables
+    global TRACE, trace_ids, trace_values, trace_count, trace_row0
+    t0 = time.perf_counter()
+    if offline_cache_file_path:
+        kwargs['offline_cache_file_path'] = offline_cache_file_path
+    particles_pos = cell_start = frame_start = density_max = None
+    soa_buffers = {}
+    kernel_tables = {}
+    ti.init(arch=ARCHES[arch] if isinstance(arch, str) else arch, debug=debug,
+            offline_cache=offline_cache, **kwargs)
+    TRACE = TRACE if trace is None else trace
+    trace_ids = trace_values = trace_count = trace_row0 = None
+    trace_scales.clear()
+    if TRACE:
+        trace_ids = ti.Vector.field(3, dtype=ti.i32, shape=TRACE_CAPACITY)
+        trace_values = ti.Vector.field(4, dtype=ti.f32, shape=TRACE_CAPACITY)
+        trace_count = ti.field(dtype=ti.i32, shape=())
+        trace_row0 = ti.field(dtype=ti.i32, shape=())
+    elapsed = time.perf_counter() - t0
+    print(f"Taichi started on {current_arch()} in {elapsed * 1000:.0f} ms "
+          f"(debug={debug}, offline cache={offline_cache}, trace={TRACE})")
+    return elapsed
+
+
+def current_arch():
+    return ti.lang.impl.current_cfg().arch.name
+
+
+def ensure_init():
+    # Если Taichi ещё не инициализирован (например, в CI), стартуем на CPU
+    if ti.lang.impl.get_runtime().prog is None:
+        init(arch='cpu')
+
+
+@ti.func
+def trace(source: ti.template(), k, i, value):
+    # Запись выборки в буфер трассировки; при TRACE = False не компилируется вовсе.
+    # Место в буфере - атомарным счётчиком, параллельный цикл не сериализуется
+    if ti.static(TRACE):
+        hit = i % TRACE_STRIDE == 0
+        for t in ti.static(TRACE_INDICES):
+            if i == t:
+                hit = True
+        if hit:
+            slot = ti.atomic_add(trace_count[None], 1)
+            if slot < TRACE_CAPACITY:
+                trace_ids[slot] = ti.math.ivec3(ti.static(TRACE_SOURCES.index(source)), trace_row0[None] + k, i)
+                trace_values[slot] = value
+
+
+def read_trace():
+    # Записи трассировки с прошлого вызова: (источник, строка, номер) и значения, число
+    # записей, не поместившихся в буфер, и множители нормировки строк: значение * scales[строка] -
+    # возвращённая плотность. Буфер очищается
+    if not TRACE:
+        return np.zeros((0, 3), dtype=np.int32), np.zeros((0, 4), dtype=np.float32), 0, []
+    total = int(trace_count[None])
+    n = min(total, TRACE_CAPACITY)
+    ids = trace_ids.to_numpy()[:n]
+    values = trace_values.to_numpy()[:n]
+    scales = list(trace_scales)
+    trace_count[None] = 0
+    trace_scales.clear()
+    return ids, values, total - n, scales
+
+
+def dump_trace(path, frame):
+    # Запись кадра в лог JSON lines: строка на кадр, записи упорядочены по источнику и номеру
+    ids, values, dropped, scales = read_trace()
+    order = np.lexsort((ids[:, 2], ids[:, 1], ids[:, 0])) if len(ids) else []
+    entries = [{"source": TRACE_SOURCES[ids[j, 0]], "row": int(ids[j, 1]), "index": int(ids[j, 2]),
+                "value": [float(v) for v in values[j]]} for j in order]
+    with open(path, "a") as f:
+        f.write(json.dumps({"frame": frame, "dropped": dropped, "scales": scales, "entries": entries}) + "\n")
+    return len(entries)
+
+
+@ti.kernel
+def update_particles(particles: ti.types.ndarray(dtype=ti.math.vec3),
+                     particles_out: ti.types.ndarray(dtype=ti.math.vec3)):
+    for i in range(particles.shape[0]):
+        particles_out[i] = particles[i]
+        trace('particles', 0, i, ti.math.vec4(particles[i], 0.0))
+
+
+@ti.kernel
+def upload_ints(src: ti.types.ndarray(dtype=ti.i32), dst: ti.types.ndarray(dtype=ti.i32)):
+    for i in range(src.shape[0]):
+        dst[i] = src[i]
+
+
+@ti.kernel
+def upload_values(src: ti.types.ndarray(ndim=1), dst: ti.types.ndarray(ndim=1)):
+    for i in range(src.shape[0]):
+        dst[i] = src[i]
+
+
+@ti.func
+def to_world(world, v):
+    return (world @ ti.math.vec4(v, 1.0)).xyz
+
+
+def kernel_support(kernel, h, cutoff_factor=3.0):
+    # Радиус носителя ядра: для гаусса - радиус обрезки
+    if kernel not in KERNELS:
+        raise ValueError(f"Неизвестное ядро: {kernel}")
+    support = KERNELS[kernel][0]
+    return (cutoff_factor if support is None else support) * h
+
+
+def kernel_table(kernel, cutoff_factor=3.0):
+    # Таблица W по s = r^2 / support^2 на [0, 1]; не зависит от h, поэтому строится один раз
+    key = (kernel, cutoff_factor if KERNELS[kernel][0] is None else None)
+    table = kernel_tables.get(key)
+    if table is None:
+        support = kernel_support(kernel, 1.0, cutoff_factor)
+        s = np.linspace(0.0, 1.0, LUT_SIZE + 1)
+        values = KERNELS[kernel][1](np.sqrt(s) * support).astype(np.float32)
+        values[-1] = 0.0  # на границе носителя вклад обнуляется
+        table = ti.ndarray(dtype=ti.f32, shape=LUT_SIZE + 1)
+        table.from_numpy(values)
+        kernel_tables[key] = table
+    return table
+
+
+@ti.func
+def lut_value(lut: ti.template(), x):
+    # Линейная интерполяция по таблице, x = r^2 / support^2 * LUT_SIZE в [0, LUT_SIZE].
+    # При r^2 чуть меньше support^2 произведение округляется до LUT_SIZE ровно: номер
+    # ограничивается, чтобы lut[k + 1] не вышел за последний узел
+    k = ti.min(ti.cast(x, ti.i32), LUT_SIZE - 1)
+    return lut[k] + (lut[k + 1] - lut[k]) * (x - k)
+
+
+@ti.func
+def kernel_exact(kind: ti.template(), d2, h):
+    # Аналитическое значение ядра для эталонного режима 'brute'
+    q2 = d2 / (h * h)
+    w = 0.0
+    if ti.static(KERNEL_NAMES[kind] == 'gaussian'):
+        w = ti.exp(-0.5 * q2)
+    if ti.static(KERNEL_NAMES[kind] == 'cubic_spline'):
+        q = ti.sqrt(q2)
+        if q < 1.0:
+            w = 1.0 - 1.5 * q2 + 0.75 * q2 * q
+        elif q < 2.0:
+            w = 0.25 * (2.0 - q) ** 3
+    if ti.static(KERNEL_NAMES[kind] == 'wendland_c2'):
+        q = ti.sqrt(q2)
+        if q < 2.0:
+            w = (1.0 - 0.5 * q) ** 4 * (2.0 * q + 1.0)
+    if ti.static(KERNEL_NAMES[kind] == 'poly6'):
+        if q2 < 4.0:
+            w = (1.0 - 0.25 * q2) ** 3
+    return w
+
+
+@ti.kernel
+def calculate_density(vertices: ti.types.ndarray(dtype=ti.math.vec3), world: ti.math.mat4,
+                      particles: ti.types.ndarray(dtype=ti.math.vec3), part_start: ti.types.ndarray(dtype=ti.i32),
+                      h: ti.f32, density_out: ti.types.ndarray(dtype=ti.f32, ndim=2), scale: ti.f32,
+                      kind: ti.template(), block_dim: ti.template()):
+    # Эталонный перебор всех пар вершина-частица, ядро считается аналитически
+    # (гаусс - без обрезки).
+    # Ядро считает пакет из K кадров (density_out - K x V): частицы кадра k лежат подряд
+    # в [part_start[k], part_start[k + 1]). Внешний цикл по кадрам и вершинам полностью
+    # параллельный: каждая итерация пишет только свою ячейку, максимум для нормировки
+    # считается отдельно в reduce_density_max.
+    # Вершины приходят в локальных координатах объекта, world - его matrix_world
+    if ti.static(block_dim):
+        ti.loop_config(block_dim=block_dim)
+    for k, i in ti.ndrange(density_out.shape[0], vertices.shape[0]):
+        vert_pos = to_world(world, vertices[i])
+        density = 0.0
+        for j in range(part_start[k], part_start[k + 1]):
+            density += kernel_exact(kind, (vert_pos - particles[j]).norm_sqr(), h)
+        density_out[k, i] = density * scale
+        trace('brute', k, i, ti.math.vec4(vert_pos, density * scale))
+
+
+@ti.kernel
+def calculate_density_grid(vertices: ti.types.ndarray(dtype=ti.math.vec3), world: ti.math.mat4,
+                           particles: ti.types.ndarray(dtype=ti.math.vec3),
+                           cell_start: ti.types.ndarray(dtype=ti.i32),
+                           lut: ti.types.ndarray(dtype=ti.f32), support: ti.f32,
+                           ox: ti.f32, oy: ti.f32, oz: ti.f32, cell: ti.f32,
+                           nx: ti.i32, ny: ti.i32, nz: ti.i32,
+                           density_out: ti.types.ndarray(dtype=ti.f32, ndim=2), scale: ti.f32,
+                           block_dim: ti.template()):
+    # Ядро с носителем радиуса support из таблицы lut: каждая вершина смотрит
+    # только частицы из 27 соседних ячеек (ячейка не меньше support).
+    # Пакет из K кадров: у каждого кадра своя таблица начал ячеек
+    # cell_start[k * (ячеек + 1):], смещения в ней - в общем массиве частиц пакета
+    support2 = support * support
+    lut_scale = LUT_SIZE / support2
+    origin = ti.math.vec3(ox, oy, oz)
+    dims = ti.math.ivec3(nx, ny, nz)
+    stride = nx * ny * nz + 1
+    if ti.static(block_dim):
+        ti.loop_config(block_dim=block_dim)
+    for k, i in ti.ndrange(density_out.shape[0], vertices.shape[0]):
+        vert_pos = to_world(world, vertices[i])
+        base = ti.floor((vert_pos - origin) / cell, ti.i32)
+        density = 0.0
+        for dx, dy, dz in ti.ndrange((-1, 2), (-1, 2), (-1, 2)):
+            c = base + ti.math.ivec3(dx, dy, dz)
+            if 0 <= c[0] < dims[0] and 0 <= c[1] < dims[1] and 0 <= c[2] < dims[2]:
+                cid = k * stride + (c[0] * dims[1] + c[1]) * dims[2] + c[2]
+                for j in range(cell_start[cid], cell_start[cid + 1]):
+                    dist2 = (vert_pos - particles[j]).norm_sqr()
+                    if dist2 < support2:
+                        density += lut_value(lut, dist2 * lut_scale)
+        density_out[k, i] = density * scale
+        trace('grid', k, i, ti.math.vec4(vert_pos, density * scale))
+
+
+@ti.kernel
+def calculate_density_soa(vertices: ti.types.ndarray(dtype=ti.math.vec3), world: ti.math.mat4,
+                          px: ti.types.ndarray(ndim=1), py: ti.types.ndarray(ndim=1), pz: ti.types.ndarray(ndim=1),
+                          cell_start: ti.types.ndarray(dtype=ti.i32),
+                          lut: ti.types.ndarray(dtype=ti.f32), support: ti.f32,
+                          ox: ti.f32, oy: ti.f32, oz: ti.f32, cell: ti.f32,
+                          nx: ti.i32, ny: ti.i32, nz: ti.i32, reach: ti.i32,
+                          density_out: ti.types.ndarray(dtype=ti.f32), scale: ti.f32, block_dim: ti.template()):
+    # Как calculate_density_grid, но для одного куска частиц режима 'large': координаты
+    # частиц - SoA относительно угла ячейки (float16 или float32), вклад куска прибавляется
+    # к density_out. Ячейки мельче носителя: вершина обходит reach ячеек в каждую сторону
+    # и пропускает те, что целиком дальше носителя. Вершина переводится в координаты
+    # угла ячейки один раз на ячейку
+    support2 = support * support
+    lut_scale = LUT_SIZE / support2
+    origin = ti.math.vec3(ox, oy, oz)
+    dims = ti.math.ivec3(nx, ny, nz)
+    if ti.static(block_dim):
+        ti.loop_config(block_dim=block_dim)
+    for i in range(vertices.shape[0]):
+        vert_pos = to_world(world, vertices[i])
+        base = ti.floor((vert_pos - origin) / cell, ti.i32)
+        density = 0.0
+        for dx, dy, dz in ti.ndrange((-reach, reach + 1), (-reach, reach + 1), (-reach, reach + 1)):
+            c = base + ti.math.ivec3(dx, dy, dz)
+            local = vert_pos - (origin + ti.cast(c, ti.f32) * cell)
+            # Расстояние от вершины до ближайшей точки ячейки
+            gap = ti.max(-local, 0.0) + ti.max(local - cell, 0.0)
+            if (0 <= c[0] < dims[0] and 0 <= c[1] < dims[1] and 0 <= c[2] < dims[2]
+                    and gap.norm_sqr() < support2):
+                cid = (c[0] * dims[1] + c[1]) * dims[2] + c[2]
+                for j in range(cell_start[cid], cell_start[cid + 1]):
+                    d = local - ti.math.vec3(ti.cast(px[j], ti.f32), ti.cast(py[j], ti.f32),
+                                             ti.cast(pz[j], ti.f32))
+                    dist2 = d.norm_sqr()
+                    if dist2 < support2:
+                        density += lut_value(lut, dist2 * lut_scale)
+        density_out[i] += density * scale
+
+
+@ti.kernel
+def trace_density(source: ti.template(), vertices: ti.types.ndarray(dtype=ti.math.vec3), world: ti.math.mat4,
+                  density: ti.types.ndarray(dtype=ti.f32), k: ti.i32):
+    # Трассировка готовой плотности кадра там, где ядро не видит итог: в calculate_density_soa
+    # ('large') только сумма по кускам частиц до текущего, в инкрементальном режиме - только
+    # изменения. Вызывается только при TRACE
+    for i in range(vertices.shape[0]):
+        trace(source, k, i, ti.math.vec4(to_world(world, vertices[i]), density[i]))
+
+
+@ti.kernel
+def reduce_density_max(density: ti.types.ndarray(dtype=ti.f32), result: ti.types.ndarray(dtype=ti.f32)):
+    # atomic_max коммутативен, поэтому результат не зависит от порядка потоков;
+    # Taichi сначала сворачивает максимум внутри блока и только потом делает атомарную запись
+    result[0] = 0.0
+    for i in range(density.shape[0]):
+        ti.atomic_max(result[0], density[i])
+
+
+@ti.kernel
+def scale_density(density: ti.types.ndarray(dtype=ti.f32), scale: ti.f32):
+    for i in range(density.shape[0]):
+        density[i] *= scale
+
+
+def normalize_density(density):
+    # Нормировка на максимум; возвращает применённый множитель
+    global density_max
+    if density_max is None:
+        density_max = ti.ndarray(dtype=ti.f32, shape=1)
+    reduce_density_max(density, density_max)
+    m = density_max[0]
+    if m > 0.0:
+        scale_density(density, 1.0 / m)
+        return 1.0 / m
+    return 1.0
+
+
+def device_buffer(buf, dtype, n):
+    # Буфер на устройстве минимум на n элементов; при нехватке ёмкость как минимум удваивается
+    if buf is None or buf.shape[0] < n:
+        capacity = max(n, 2 * buf.shape[0]) if buf is not None else n
+        buf = ti.ndarray(dtype=dtype, shape=capacity)
+    return buf
+
+
+def upload_particles(particles):
+    global particles_pos
+    particles_pos = device_buffer(particles_pos, ti.math.vec3, len(particles))
+    update_particles(particles, particles_pos)
+    return particles_pos
+
+
+def upload_soa(sorted_part, starts, grid, half):
+    # Кусок частиц, отсортированный по ячейкам, - на устройство тремя массивами координат
+    # относительно угла ячейки: так значения не больше ячейки и float16 хватает точности
+    global cell_start
+    dtype, np_dtype = (ti.f16, np.float16) if half else (ti.f32, np.float32)
+    ox, oy, oz, cell, nx, ny, nz = grid
+    # Ячейка частицы берётся из сортировки, а не пересчитывается: ядро прибавит именно её угол
+    cid = np.repeat(np.arange(len(starts) - 1), np.diff(starts))
+    corner = np.stack(np.unravel_index(cid, (nx, ny, nz)), axis=1) * cell + np.array([ox, oy, oz])
+    rel = sorted_part - corner
+    buffers = soa_buffers.setdefault(dtype, [None, None, None])
+    for axis in range(3):
+        buffers[axis] = device_buffer(buffers[axis], dtype, len(rel))
+        upload_values(np.ascontiguousarray(rel[:, axis], dtype=np_dtype), buffers[axis])
+    cell_start = device_buffer(cell_start, ti.i32, len(starts))
+    upload_ints(starts, cell_start)
+    return buffers
+
+
+def compute_density_large(vertices, particles, world, lo_hi, support, lut, scale, out, half=True,
+                          chunk=LARGE_CHUNK):
+    # Плотность одного кадра для режима 'large': частицы идут кусками по chunk, у каждого
+    # куска своя сортировка по общей сетке, вклады кусков накапливаются в out
+    out[:] = 0.0
+    for i in range(0, len(particles), chunk):
+        sorted_part, starts, grid, _ = build_cell_list(lo_hi, particles[i:i + chunk], support,
+                                                       support / LARGE_CELL_SPLIT)
+        if len(sorted_part):
+            # Ячейка могла вырасти из-за MAX_GRID_CELLS
+            reach = int(np.ceil(support / grid[3]))
+            px, py, pz = upload_soa(sorted_part, starts, grid, half)
+            calculate_density_soa(vertices, world, px, py, pz, cell_start, lut, support, *grid, reach, out, scale,
+                                  BLOCK_DIM)
+    return out
+
+
+def world_bounds(bounds, world):
+    # Мировые габариты по 8 углам локального бокса (с запасом для повёрнутых объектов)
+    lo, hi = bounds
+    corners = np.array([[x, y, z, 1.0] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+    corners = corners @ np.asarray(world, dtype=np.float64).T
+    return corners[:, :3].min(axis=0), corners[:, :3].max(axis=0)
+
+
+def build_cell_list(bounds, particles, cutoff, cell=None):
+    # Равномерная сетка по мировым габаритам меша, расширенным на радиус обрезки:
+    # частицы за её пределами не влияют ни на одну вершину и отбрасываются.
+    # Возвращает частицы, отсортированные по ячейкам, начала ячеек, параметры сетки для ядра
+    # и исходные индексы отсортированных частиц. По умолчанию ячейка равна радиусу обрезки
+    # (обход 3x3x3 ячеек), режим 'large' задаёт ячейку мельче
+    origin = bounds[0] - cutoff
+    extent = bounds[1] + cutoff - origin
+    cell = cutoff if cell is None else cell
+    dims = np.maximum(np.ceil(extent / cell).astype(np.int64), 1)
+    while dims.prod() > MAX_GRID_CELLS:  # ячейка крупнее радиуса обрезки тоже даёт точный результат
+        cell *= 2.0
+        dims = np.maximum(np.ceil(extent / cell).astype(np.int64), 1)
+
+    idx = np.floor((particles - origin) / cell).astype(np.int64)
+    inside = np.all((idx >= 0) & (idx < dims), axis=1)
+    ids = (idx[:, 0] * dims[1] + idx[:, 1]) * dims[2] + idx[:, 2]
+    ids = ids[inside]
+    order = np.argsort(ids, kind='stable')
+
+    ncells = int(dims.prod())
+    starts = np.zeros(ncells + 1, dtype=np.int32)
+    np.cumsum(np.bincount(ids, minlength=ncells), out=starts[1:])
+
+    index = np.flatnonzero(inside)[order].astype(np.int32)
+    sorted_part = np.ascontiguousarray(particles[index], dtype=np.float32)
+    grid = (float(origin[0]), float(origin[1]), float(origin[2]), float(cell), int(dims[0]), int(dims[1]), int(dims[2]))
+    return sorted_part, starts, grid, index
+
+
+def compute_density(vertices, particles, h, world=None, mode='grid', cutoff_factor=3.0,
+                    normalization='max', reference=1.0, bounds=None, out=None, kernel='gaussian', half=True):
+    # Плотность частиц в вершинах: сумма ядер W(d / h) по частицам (kernel - имя из KERNELS,
+    # по умолчанию гаусс exp(-d^2 / 2h^2)).
+    # vertices - (V, 3) float32 в локальных координатах (numpy или ti.ndarray на устройстве),
+    # particles - (P, 3) float32 в мировых координатах, world - matrix_world (4x4, по умолчанию единичная),
+    # bounds - (min, max) вершин в локальных координатах; для numpy вершин считается сам.
+    # mode: 'grid' - соседи по сетке в пределах носителя ядра (гаусс обрезается на cutoff_factor * h),
+    # 'brute' - все пары с аналитическим ядром,
+    # 'fft' - приближённо через БПФ на цилиндрической сетке (только для цилиндра, см. density_fft),
+    # 'large' - как 'grid', но кусками частиц в SoA, для 1e5-1e6 частиц (half - хранить координаты
+    # во float16, см. LARGE_CHUNK).
+    # normalization: 'max' - на максимум кадра, 'fixed' - на reference, 'none' - без нормировки
+    if out is None:
+        out = np.empty(vertices.shape[0], dtype=np.float32)
+    compute_density_batch(vertices, [particles], h, world, mode, cutoff_factor, normalization, reference,
+                          bounds, out.reshape(1, -1), kernel, half)
+    return out
+
+
+def compute_density_batch(vertices, frames, h, world=None, mode='grid', cutoff_factor=3.0,
+                          normalization='max', reference=1.0, bounds=None, out=None, kernel='gaussian', half=True):
+    # То же, что compute_density, сразу для K кадров одним запуском ядра: frames - (K, P, 3)
+    # или список из K массивов частиц разной длины, out - (K, V). Частицы всех кадров
+    # загружаются на устройство одной передачей. compute_density - это пакет из одного
+    # кадра через те же ядра, поэтому результаты по кадрам побитно совпадают.
+    # Матрица world и вершины общие для всего пакета. В режиме 'large' кадры считаются по очереди
+    global cell_start, frame_start
+    ensure_init()
+    if mode not in DENSITY_MODES:
+        raise ValueError(f"Неизвестный режим плотности: {mode}")
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"Неизвестная нормировка: {normalization}")
+    support = kernel_support(kernel, h, cutoff_factor)
+    if mode == 'fft' and kernel != 'gaussian':
+        raise ValueError("Режим 'fft' поддерживает только гауссово ядро")
+    world = np.eye(4, dtype=np.float32) if world is None else np.asarray(world, dtype=np.float32)
+    frames = [np.ascontiguousarray(p, dtype=np.float32).reshape(-1, 3) for p in frames]
+    if out is None:
+        out = np.empty((len(frames), vertices.shape[0]), dtype=np.float32)
+    row0 = len(trace_scales)
+    if TRACE:
+        trace_row0[None] = row0
+        trace_scales.extend([1.0] * len(frames))
+    if sum(len(p) for p in frames) == 0:
+        out[:] = 0.0
+        return out
+
+    # Фиксированная нормировка делается прямо в ядре плотности, без второго прохода
+    scale = 1.0 / reference if normalization == 'fixed' else 1.0
+    if mode in ('grid', 'large'):
+        if bounds is None:
+            bounds = (vertices.min(axis=0), vertices.max(axis=0))
+        lo_hi = world_bounds(bounds, world)
+    if mode == 'large':
+        lut = kernel_table(kernel, cutoff_factor)
+        for k, p in enumerate(frames):
+            compute_density_large(vertices, p, world, lo_hi, support, lut, scale, out[k], half)
+            if TRACE:
+                trace_density('large', vertices, world, out[k], k)
+    elif mode == 'grid':
+        # Сетка зависит только от габаритов меша и носителя, поэтому общая для всех кадров
+        lists = [build_cell_list(lo_hi, p, support) for p in frames]
+        sizes = np.cumsum([0] + [len(sorted_part) for sorted_part, _, _, _ in lists])
+        if sizes[-1] == 0:
+            out[:] = 0.0
+            return out
+        starts = np.concatenate([st + offset for (_, st, _, _), offset in zip(lists, sizes)]).astype(np.int32)
+        cell_start = device_buffer(cell_start, ti.i32, len(starts))
+        upload_ints(starts, cell_start)
+        particles = upload_particles(np.concatenate([sorted_part for sorted_part, _, _, _ in lists]))
+        calculate_density_grid(vertices, world, particles, cell_start, kernel_table(kernel, cutoff_factor),
+                               support, *lists[0][2], out, scale, BLOCK_DIM)
+    elif mode == 'fft':
+        host = vertices.to_numpy() if isinstance(vertices, ti.Ndarray) else np.asarray(vertices, dtype=np.float32)
+        for k, p in enumerate(frames):
+            if len(p):
+                np.multiply(density_fft.compute_density_fft(host, p, h, world), scale, out=out[k])
+            else:
+                out[k] = 0.0
+    else:
+        starts = np.cumsum([0] + [len(p) for p in frames]).astype(np.int32)
+        frame_start = device_buffer(frame_start, ti.i32, len(starts))
+        upload_ints(starts, frame_start)
+        calculate_density(vertices, world, upload_particles(np.concatenate(frames)), frame_start, h, out, scale,
+                          KERNEL_NAMES.index(kernel), BLOCK_DIM)
+    if normalization == 'max':
+        for k, row in enumerate(out):
+            row_scale = normalize_density(row)
+            if TRACE:
+                trace_scales[row0 + k] = row_scale
+    return out
+
+
+@ti.kernel
+def scatter_density_delta(vertices: ti.types.ndarray(dtype=ti.math.vec3), vertex_index: ti.types.ndarray(dtype=ti.i32),
+                          vcell_start: ti.types.ndarray(dtype=ti.i32),
+                          deltas: ti.types.ndarray(dtype=ti.math.vec3), weights: ti.types.ndarray(dtype=ti.f32),
+                          lut: ti.types.ndarray(dtype=ti.f32), support: ti.f32,
+                          ox: ti.f32, oy: ti.f32, oz: ti.f32, cell: ti.f32,
+                          nx: ti.i32, ny: ti.i32, nz: ti.i32,
+                          raw: ti.types.ndarray(dtype=ti.f32)):
+    # Обратная к calculate_density_grid схема: цикл по изменившимся частицам,
+    # каждая добавляет (вес +1) или вычитает (вес -1) свой вклад только в вершины
+    # из 27 соседних ячеек. vertices - мировые координаты, отсортированные по ячейкам
+    support2 = support * support
+    lut_scale = LUT_SIZE / support2
+    origin = ti.math.vec3(ox, oy, oz)
+    dims = ti.math.ivec3(nx, ny, nz)
+    for k in range(deltas.shape[0]):
+        p = deltas[k]
+        base = ti.floor((p - origin) / cell, ti.i32)
+        for dx, dy, dz in ti.ndrange((-1, 2), (-1, 2), (-1, 2)):
+            c = base + ti.math.ivec3(dx, dy, dz)
+            if 0 <= c[0] < dims[0] and 0 <= c[1] < dims[1] and 0 <= c[2] < dims[2]:
+                cid = (c[0] * dims[1] + c[1]) * dims[2] + c[2]
+                for s in range(vcell_start[cid], vcell_start[cid + 1]):
+                    dist2 = (vertices[s] - p).norm_sqr()
+                    if dist2 < support2:
+                        ti.atomic_add(raw[vertex_index[s]], weights[k] * lut_value(lut, dist2 * lut_scale))
+
+
+class IncrementalDensity:
+    # Инкрементальный пересчёт плотности между соседними кадрами воспроизведения.
+    # Частицы передаются целиком, с постоянными индексами, и маской живых. Между кадрами
+    # N и N + 1 вычитается старый и добавляется новый вклад только тех частиц, которые
+    # сместились больше чем на tolerance, родились или умерли; затрагиваются только
+    # вершины в пределах носителя ядра от них. Полный пересчёт - при скачке по кадрам, смене
+    # параметров или меша и каждые refresh_interval кадров (ограничивает накопление
+    # ошибки округления). Ядро то же, что в режиме 'grid' (табличное).
+    def __init__(self, tolerance=1e-3, refresh_interval=50):
+        self.tolerance = tolerance
+        self.refresh_interval = refresh_interval
+        self.full_updates = 0
+        self.incremental_updates = 0
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.frame = None
+        self.raw = None  # ненормированная плотность в вершинах
+        self.prev_pos = None  # позиции, вклад которых сейчас учтён в raw
+        self.prev_alive = None
+        self.since_refresh = 0
+
+    def update(self, frame, vertices, positions, alive, h, world=None, cutoff_factor=3.0,
+               normalization='max', reference=1.0, bounds=None, key=None, out=None, kernel='gaussian'):
+        # positions - (N, 3) все частицы системы, alive - (N,) bool; key - внешний отпечаток
+        # состояния (например, настройки и кеш частиц), при его смене - полный пересчёт
+        ensure_init()
+        world = np.eye(4, dtype=np.float32) if world is None else np.asarray(world, dtype=np.float32)
+        positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3)
+        alive = np.asarray(alive, dtype=bool)
+        full_key = (key, vertices.shape[0], len(positions), world.tobytes(), h, cutoff_factor, kernel)
+        if TRACE:
+            # Записи 'grid' полного пересчёта (без нормировки) заменяются одной строкой 'incremental'
+            count0, row0 = trace_count[None], len(trace_scales)
+        if (full_key != self.key or self.frame is None or frame != self.frame + 1
+                or self.since_refresh >= self.refresh_interval):
+            self.full_update(vertices, positions, alive, h, world, cutoff_factor, bounds, kernel)
+            self.key = full_key
+        else:
+            self.delta_update(positions, alive)
+        self.frame = frame
+
+        if out is None:
+            out = np.empty(vertices.shape[0], dtype=np.float32)
+        scale = 1.0
+        if normalization == 'fixed':
+            scale = 1.0 / reference
+            np.multiply(self.raw, scale, out=out)
+        else:
+            out[:] = self.raw
+            if normalization == 'max':
+                scale = normalize_density(out)
+        if TRACE:
+            trace_count[None] = count0
+            del trace_scales[row0:]
+            trace_row0[None] = row0
+            trace_scales.append(scale)
+            trace_density('incremental', vertices, world, self.raw, 0)
+        return out
+
+    def full_update(self, vertices, positions, alive, h, world, cutoff_factor, bounds, kernel):
+        self.full_updates += 1
+        self.since_refresh = 0
+        self.support = kernel_support(kernel, h, cutoff_factor)
+        self.lut = kernel_table(kernel, cutoff_factor)
+        self.raw = compute_density(vertices, positions[alive], h, world, mode='grid', cutoff_factor=cutoff_factor,
+                                   normalization='none', bounds=bounds, kernel=kernel)
+        # Сетка по вершинам в мировых координатах для точечных обновлений
+        local = vertices.to_numpy() if isinstance(vertices, ti.Ndarray) else np.asarray(vertices, dtype=np.float32)
+        world_verts = (local @ world[:3, :3].T + world[:3, 3]).astype(np.float32)
+        bounds_world = (world_verts.min(axis=0), world_verts.max(axis=0))
+        self.vertices, starts, self.grid, index = build_cell_list(bounds_world, world_verts, self.support)
+        self.vertex_index = index
+        self.vcell_start = starts
+        self.prev_pos = positions.copy()
+        self.prev_alive = alive.copy()
+
+    def delta_update(self, positions, alive):
+        self.incremental_updates += 1
+        self.since_refresh += 1
+        moved = ((positions - self.prev_pos) ** 2).sum(axis=1) > self.tolerance * self.tolerance
+        removed = self.prev_alive & (moved | ~alive)
+        added = alive & (moved | ~self.prev_alive)
+        if removed.any() or added.any():
+            deltas = np.concatenate([self.prev_pos[removed], positions[added]])
+            weights = np.concatenate([np.full(np.count_nonzero(removed), -1.0, dtype=np.float32),
+                                      np.ones(np.count_nonzero(added), dtype=np.float32)])
+            scatter_density_delta(self.vertices, self.vertex_index, self.vcell_start, deltas, weights,
+                                  self.lut, self.support, *self.grid, self.raw)
+        # Частицы, сдвинувшиеся меньше tolerance, остаются учтёнными в старой позиции:
+        # ошибка от них не накапливается, а ограничена самим tolerance
+        changed = moved | (alive != self.prev_alive)
+        self.prev_pos[changed] = positions[changed]
+        self.prev_alive = alive.copy()
+
+
+def check_density_accuracy(vertices, particles, h, world=None, bounds=None, cutoff_factor=3.0, mode='grid', **kwargs):
+    # Сравнение приближённого режима ('grid' или 'fft') с эталонным перебором 'brute'
+    reference = compute_density(vertices, particles, h, world, mode='brute', bounds=bounds, **kwargs)
+    approx = compute_density(vertices, particles, h, world, mode=mode, cutoff_factor=cutoff_factor,
+                             bounds=bounds, **kwargs)
+    err = np.abs(approx - reference)
+    print(f"Density check ({mode}, {kwargs.get('kernel', 'gaussian')}): max abs error {err.max():.6f}, "
+          f"mean abs error {err.mean():.6f}")
+    return float(err.max())
+
+
+def check_trace(density):
+    # Сверка трассировки с плотностью, возвращённой с прошлого read_trace: density - строки
+    # в порядке вызовов (кадры пакетов подряд). Значение записи, умноженное на множитель своей
+    # строки, должно дать density[строка, номер]. Забирает буфер; возвращает наибольшее расхождение
+    ids, values, dropped, scales = read_trace()
+    density = np.asarray(density, dtype=np.float32).reshape(len(scales), -1)
+    sel = ids[:, 0] != TRACE_SOURCES.index('particles')
+    rows, index = ids[sel, 1], ids[sel, 2]
+    err = np.abs(values[sel, 3] * np.asarray(scales, dtype=np.float32)[rows] - density[rows, index])
+    max_err = float(err.max()) if len(err) else 0.0
+    print(f"Trace check ({len(err)} entries over {len(scales)} rows, {dropped} dropped): "
+          f"max abs error {max_err:.3g}")
+    return max_err
+
+
+def warm_up(vertices, n_particles, h, world=None, bounds=None, modes=('grid',), **kwargs):
+    # Прогрев: компилирует ядра и выделяет буферы на устройстве под реальные размеры
+    # меша и числа частиц, чтобы первый кадр не платил за JIT. Частицы синтетические,
+    # в габаритах меша. Возвращает время прогрева в секундах
+    ensure_init()
+    t0 = time.perf_counter()
+    world = np.eye(4, dtype=np.float32) if world is None else np.asarray(world, dtype=np.float32)
+    if bounds is None:
+        bounds = (vertices.min(axis=0), vertices.max(axis=0))
+    lo, hi = world_bounds(bounds, world)
+    particles = np.random.default_rng(0).uniform(lo, hi, (max(n_particles, 1), 3)).astype(np.float32)
+    out = np.empty(vertices.shape[0], dtype=np.float32)
+    for mode in modes:
+        if mode == 'incremental':
+            # Два соседних кадра: полный пересчёт и точечное обновление
+            inc = IncrementalDensity()
+            alive = np.ones(len(particles), dtype=bool)
+            inc.update(0, vertices, particles, alive, h, world, bounds=bounds, out=out, **kwargs)
+            particles[0] += 1.0
+            inc.update(1, vertices, particles, alive, h, world, bounds=bounds, out=out, **kwargs)
+        else:
+            compute_density(vertices, particles, h, world, mode=mode, bounds=bounds, out=out, **kwargs)
+    ti.sync()
+    return time.perf_counter() - t0
@@ -0,0 +1,44 @@
+# Уровень детализации (LOD) для плотности: ядро считается не во всех вершинах плотного
+# меша, а в узлах грубой регулярной решётки с шагом порядка h, окружающей поверхность
+# (только узлы ячеек, в которые попала хотя бы одна вершина). Плотность в вершинах -
+# трилинейная интерполяция по 8 узлам своей ячейки. Веса постоянны для данного меша и
+# хранятся как разреженная матрица V x M в формате ELL: 8 индексов узлов и 8 весов на вершину.
+#
+# Плотность меняется на масштабе h, поэтому при шаге h / 2 ошибка интерполяции гаусса
+# около 2% от максимума, а стоимость ядра зависит от числа узлов, а не вершин:
+# решётка на цилиндре R=3, H=15 при h=1.5 - около 1.3 тыс. узлов при любом подразделении меша.
+# Нормировку по максимуму нужно делать после интерполяции: максимум в узлах внутри цилиндра
+# выше, чем на поверхности.
+import numpy as np
+
+LOD_SPACING = 0.5  # шаг решётки в единицах h
+
+CORNERS = np.array([(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=np.int64)
+
+
+def build_lod(vertices, spacing):
+    # vertices - (V, 3) локальные координаты, spacing - шаг решётки.
+    # Возвращает узлы (M, 3) float32, индексы (V, 8) int32 и веса (V, 8) float32
+    vertices = np.asarray(vertices, dtype=np.float64)
+    origin = vertices.min(axis=0)
+    f = (vertices - origin) / spacing
+    base = np.floor(f).astype(np.int64)
+    frac = f - base
+    dims = base.max(axis=0) + 2
+    ids = np.empty((len(vertices), 8), dtype=np.int64)
+    weights = np.empty((len(vertices), 8), dtype=np.float64)
+    for c, corner in enumerate(CORNERS):
+        ids[:, c] = np.ravel_multi_index((base + corner).T, dims)
+        weights[:, c] = np.prod(np.where(corner == 1, frac, 1.0 - frac), axis=1)
+    # Нумерация только занятых узлов
+    used, index = np.unique(ids, return_inverse=True)
+    nodes = origin + spacing * np.stack(np.unravel_index(used, dims), axis=1)
+    return nodes.astype(np.float32), index.reshape(ids.shape).astype(np.int32), weights.astype(np.float32)
+
+
+def interpolate(node_density, index, weights, out=None):
+    # Плотность в вершинах из плотности в узлах: out = W @ node_density
+    if out is None:
+        out = np.empty(len(index), dtype=np.float32)
+    np.einsum('ij,ij->i', node_density[index], weights, out=out)
+    return out
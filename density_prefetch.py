@@ -0,0 +1,110 @@
+# Фоновый расчёт плотности следующих кадров при воспроизведении.
+# Обработчик кадра забирает готовый буфер (take) и заказывает следующие кадры (request),
+# фоновый поток считает их, пока Блендер показывает текущий. Готовые кадры лежат в
+# кольце из нескольких буферов: отданный буфер возвращается в кольцо через release.
+# Состояние сцены (state, как в DensityCache) сбрасывает всё насчитанное.
+#
+# Расчёт задаётся функцией job(кадр, буфер или None) -> (массив плотности, проверка); проверка -
+# отпечаток частиц, по которым посчитан кадр, и take отдаёт кадр, только если она совпала
+# с проверкой частиц, которые видит основной поток. job выполняется
+# под lock, и этот же lock должен держать синхронный расчёт в основном потоке: буферы
+# density_core и запуск ядер Taichi не рассчитаны на два потока сразу. bpy из фонового
+# потока не читается - job берёт частицы из заранее записанной траектории.
+import threading
+
+
+class DensityPrefetcher:
+    def __init__(self, depth=2, lock=None):
+        self.depth = depth  # сколько кадров вперёд держать готовыми
+        self.lock = lock or threading.Lock()
+        self.cond = threading.Condition()
+        self.ready = {}  # кадр -> (массив плотности, проверка)
+        self.pending = []  # кадры в очереди на расчёт
+        self.wanted = set()  # последний заказ
+        self.inflight = None  # кадр, который считается сейчас
+        self.free = []  # свободные буферы кольца
+        self.state = None
+        self.job = None
+        self.thread = None
+        self.running = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="density-prefetch", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sync_state(self, state):
+        # Вызывается под self.cond
+        if state != self.state:
+            self.ready.clear()
+            self.free.clear()
+            self.pending = []
+            self.state = state
+
+    def take(self, frame, state, check=None):
+        # Готовая плотность кадра или None; буфер нужно вернуть через release
+        with self.cond:
+            self.sync_state(state)
+            density, ready_check = self.ready.pop(frame, (None, None))
+            if density is not None and ready_check != check:
+                self.free.append(density)
+                density = None
+        if density is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return density
+
+    def release(self, density):
+        with self.cond:
+            if len(self.free) <= self.depth:
+                self.free.append(density)
+
+    def request(self, frames, state, job):
+        # Заказ следующих кадров; насчитанное для других кадров возвращается в кольцо
+        frames = list(frames)[:self.depth]
+        with self.cond:
+            self.sync_state(state)
+            self.job = job
+            self.wanted = set(frames)
+            for frame in [f for f in self.ready if f not in self.wanted]:
+                self.free.append(self.ready.pop(frame)[0])
+            self.pending = [f for f in frames if f not in self.ready and f != self.inflight]
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                frame = self.inflight = self.pending.pop(0)
+                state, job = self.state, self.job
+                out = self.free.pop() if self.free else None
+            try:
+                with self.lock:
+                    density, check = job(frame, out)
+            except Exception as e:
+                print(f"Density prefetch failed on frame {frame}: {e}")
+                density = None
+            with self.cond:
+                self.inflight = None
+                if density is not None and state == self.state and frame in self.wanted:
+                    self.ready[frame] = (density, check)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"Density prefetch: hits {self.hits}, misses {self.misses} ({rate:.0%}), depth {self.depth}"
@@ -0,0 +1,172 @@
+# Компактный формат последовательности кадров плотности (.dens) вместо float32 .npy.
+# Каждый кадр квантуется в 8 или 16 бит по своему диапазону [min, max] (шаг и смещение
+# хранятся на кадр), по желанию - дельтами от предыдущего восстановленного кадра.
+# Кадры идут кусками по chunk_frames: первый кадр куска всегда абсолютный, поэтому для
+# любого кадра достаточно прочитать и распаковать один кусок. Кусок сжимается zlib.
+#
+# Файл: b"DENS", длина и JSON заголовка (биты, вершины, первый кадр, размер куска, дельты,
+# сжатие), затем куски подряд, в конце индекс - смещения кусков (int64, кусков + 1),
+# и 16 байт: смещение индекса и число кадров. Писатель потоковый: кадры пишутся по мере
+# расчёта, в памяти держится только текущий кусок. Читатель открывает файл через memmap
+# и распаковывает только нужный кусок; последний распакованный кусок запоминается,
+# поэтому при воспроизведении подряд чтение идёт раз в chunk_frames кадров.
+#
+#   python density_store.py density_bake.npy density_bake.dens --bits 8 --delta
+import argparse
+import json
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"DENS"
+VERSION = 1
+BITS = {8: np.uint8, 16: np.uint16}
+FOOTER = struct.Struct("<qq")  # смещение индекса, число кадров
+
+
+def quantize(values, bits):
+    # Квантование по диапазону кадра: values ~ offset + q * step
+    qmax = (1 << bits) - 1
+    lo, hi = float(values.min()), float(values.max())
+    step = np.float32((hi - lo) / qmax if hi > lo else 1.0)
+    q = np.rint((values - np.float32(lo)) / step).clip(0, qmax).astype(BITS[bits])
+    return q, np.float32(lo), step
+
+
+def dequantize(q, offset, step):
+    return q.astype(np.float32) * step + offset
+
+
+class DensityWriter:
+    def __init__(self, path, vertices, frame_start=0, bits=8, delta=False, chunk_frames=32, compress=True):
+        if bits not in BITS:
+            raise ValueError(f"Поддерживается квантование в 8 или 16 бит, а не {bits}")
+        self.file = open(path, "wb")
+        self.vertices = vertices
+        self.bits = bits
+        self.delta = delta
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        header = json.dumps({"version": VERSION, "bits": bits, "vertices": vertices, "frame_start": frame_start,
+                             "chunk_frames": chunk_frames, "delta": delta, "compress": compress}).encode()
+        self.file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        self.offsets = []
+        self.n_frames = 0
+        self.params = []  # (смещение, шаг) кадров текущего куска
+        self.codes = []  # квантованные кадры текущего куска
+        self.prev = None  # восстановленный предыдущий кадр для дельт
+
+    def write(self, density):
+        density = np.asarray(density, dtype=np.float32).reshape(self.vertices)
+        if self.delta and self.codes:
+            # Дельта от того, что восстановит читатель, иначе ошибка накапливалась бы
+            q, offset, step = quantize(density - self.prev, self.bits)
+            self.prev = self.prev + dequantize(q, offset, step)
+        else:
+            q, offset, step = quantize(density, self.bits)
+            self.prev = dequantize(q, offset, step)
+        self.params.append((offset, step))
+        self.codes.append(q)
+        self.n_frames += 1
+        if len(self.codes) == self.chunk_frames:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        if not self.codes:
+            return
+        data = np.array(self.params, dtype=np.float32).tobytes() + np.stack(self.codes).tobytes()
+        self.offsets.append(self.file.tell())
+        self.file.write(zlib.compress(data, 6) if self.compress else data)
+        self.params = []
+        self.codes = []
+
+    def close(self):
+        self.flush_chunk()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.offsets + [index_offset], dtype=np.int64).tobytes())
+        self.file.write(FOOTER.pack(index_offset, self.n_frames))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DensityReader:
+    # Для update_density выглядит как массив (кадры, вершины) только для чтения по строкам
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:4]) != MAGIC:
+            raise ValueError(f"{path}: не файл плотности .dens")
+        (size,) = struct.unpack("<I", bytes(self.data[4:8]))
+        self.meta = json.loads(bytes(self.data[8:8 + size]))
+        self.bits = self.meta["bits"]
+        self.vertices = self.meta["vertices"]
+        self.frame_start = self.meta["frame_start"]
+        self.chunk_frames = self.meta["chunk_frames"]
+        index_offset, self.n_frames = FOOTER.unpack(bytes(self.data[-FOOTER.size:]))
+        self.offsets = np.frombuffer(self.data[index_offset:len(self.data) - FOOTER.size], dtype=np.int64)
+        self.shape = (self.n_frames, self.vertices)
+        self.chunk = None  # (номер, кадры куска)
+
+    def __len__(self):
+        return self.n_frames
+
+    def read_chunk(self, c):
+        raw = self.data[self.offsets[c]:self.offsets[c + 1]]
+        raw = zlib.decompress(raw) if self.meta["compress"] else bytes(raw)
+        n = min(self.chunk_frames, self.n_frames - c * self.chunk_frames)
+        params = np.frombuffer(raw, dtype=np.float32, count=2 * n).reshape(n, 2)
+        q = np.frombuffer(raw, dtype=BITS[self.bits], offset=8 * n).reshape(n, self.vertices)
+        frames = dequantize(q, params[:, :1], params[:, 1:])
+        if self.meta["delta"]:
+            # Последовательное суммирование в float32 - в том же порядке, что у писателя
+            for k in range(1, n):
+                frames[k] += frames[k - 1]
+        return frames
+
+    def __getitem__(self, k):
+        # k - номер кадра от начала последовательности
+        if not 0 <= k < self.n_frames:
+            raise IndexError(k)
+        c = k // self.chunk_frames
+        if self.chunk is None or self.chunk[0] != c:
+            self.chunk = (c, self.read_chunk(c))
+        return self.chunk[1][k % self.chunk_frames]
+
+
+def convert(src, dst, bits=8, delta=False, chunk_frames=32, frame_start=None):
+    # Экспорт запечки .npy (с .json рядом) в .dens, кадры читаются из memmap по одному
+    frames = np.load(src, mmap_mode='r')
+    if frame_start is None:
+        try:
+            with open(src + ".json") as f:
+                frame_start = json.load(f)["frame_start"]
+        except OSError:
+            frame_start = 0
+    with DensityWriter(dst, frames.shape[1], frame_start, bits, delta, chunk_frames) as writer:
+        for row in frames:
+            writer.write(row)
+    return DensityReader(dst)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="density_store.py", description="Экспорт запечки плотности в .dens")
+    parser.add_argument("src", help="запечка .npy")
+    parser.add_argument("dst", help="файл .dens")
+    parser.add_argument("--bits", type=int, default=8, choices=sorted(BITS))
+    parser.add_argument("--delta", action="store_true", help="дельты между соседними кадрами")
+    parser.add_argument("--chunk", type=int, default=32, help="кадров в куске")
+    args = parser.parse_args(argv)
+    reader = convert(args.src, args.dst, args.bits, args.delta, args.chunk)
+    frames = np.load(args.src, mmap_mode='r')
+    err = max(float(np.abs(reader[k] - frames[k]).max()) for k in range(len(frames)))
+    print(f"{args.dst}: {len(reader)} frames, {reader.data.nbytes / 1024 / 1024:.1f} MB "
+          f"(npy {frames.nbytes / 1024 / 1024:.1f} MB), max abs error {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# Автоподбор параметров расчёта плотности под машину и размер задачи.
+# Короткие замеры на реальном меше и числе частиц (частицы синтетические, в габаритах меша,
+# как в density_core.warm_up): режим ('grid', 'large' с разной ячейкой и точностью, 'brute',
+# 'fft'), число потоков CPU и размер пакета кадров для запечки. Из конфигураций, у которых
+# ошибка на выборке вершин относительно 'brute' не больше tolerance (от максимума плотности),
+# берётся самая быстрая; для неё затем подбирается block_dim цикла по вершинам
+# (density_core.BLOCK_DIM) и размер пакета. Результат пишется в JSON по ключу машины и задачи, и следующий
+# запуск берёт его сразу, без замеров.
+#
+# Ключ машины - имя хоста, процессор, число ядер, бэкенд Taichi и его версия; ключ задачи -
+# число вершин, число частиц с точностью до степени двойки, ядро, h, обрезка и допустим ли 'fft'.
+# Число потоков подбирается, только если задан список threads: для каждого значения Taichi
+# перезапускается (density_core.init), поэтому буферы на устройстве создаются заново.
+#
+#   python density_tune.py --level 2 --particles 100000
+import argparse
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import taichi as ti
+
+import density_core
+
+TUNE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "density_tune.json")
+TOLERANCE = 0.05  # обрезка гаусса на 3h сама даёт около 2% от максимума
+REPEATS = 3  # замеров на конфигурацию после прогрева
+TRIAL_BUDGET = 2.0  # секунд на замеры одной конфигурации, дальше повторы не делаются
+SAMPLE_VERTICES = 256  # вершин в выборке для сверки с 'brute'
+MAX_BRUTE_PAIRS = 2e8  # 'brute' целиком пробуется только на небольших задачах
+BATCHES = (1, 2, 4, 8, 16)
+BLOCK_DIMS = (32, 64, 128, 256, 512)  # кроме 0 - значения Taichi по умолчанию, оно замерено в первом проходе
+MAX_BATCH_PARTICLES = 1 << 22  # частиц в пакете при подборе размера пакета
+
+
+def machine_key():
+    return "|".join([platform.node(), platform.machine(), platform.processor() or "?",
+                     f"{os.cpu_count()} cpus", density_core.current_arch(), f"taichi {ti.__version__}"])
+
+
+def problem_key(n_vertices, n_particles, h, kernel, cutoff_factor, fft=False):
+    bucket = 1 << max(0, int(round(np.log2(max(n_particles, 1)))))
+    return f"V{n_vertices} P~{bucket} {kernel} h={h:g} cut={cutoff_factor:g}" + (" fft" if fft else "")
+
+
+def candidates(n_vertices, n_particles, kernel, fft=False):
+    # Конфигурации для замера: режим и его параметры
+    configs = [{"mode": 'grid'}]
+    for cell_split in (1, 2, 4):
+        for half in (False, True):
+            configs.append({"mode": 'large', "cell_split": cell_split, "half": half})
+    if fft and kernel == 'gaussian':
+        configs.append({"mode": 'fft'})
+    if n_vertices * n_particles <= MAX_BRUTE_PAIRS:
+        configs.append({"mode": 'brute'})
+    return configs
+
+
+def run_config(config, vertices, frames, h, world, bounds, kernel, cutoff_factor, out):
+    density_core.LARGE_CELL_SPLIT = config.get("cell_split", density_core.LARGE_CELL_SPLIT)
+    density_core.BLOCK_DIM = config.get("block_dim", 0)
+    density_core.compute_density_batch(vertices, frames, h, world, config["mode"], cutoff_factor, 'none',
+                                       bounds=bounds, out=out, kernel=kernel, half=config.get("half", True))
+    ti.sync()
+    return out
+
+
+def timed_trials(fn):
+    # Первый вызов - прогрев (JIT, буферы), затем медиана до REPEATS замеров в пределах TRIAL_BUDGET
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < REPEATS and time.perf_counter() - start < TRIAL_BUDGET:
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+
+def tune(vertices, n_particles, h, world=None, bounds=None, kernel='gaussian', cutoff_factor=3.0,
+         tolerance=TOLERANCE, fft=False, threads=(), batches=BATCHES, block_dims=BLOCK_DIMS, arch='cpu'):
+    # Замеры всех конфигураций; возвращает лучшую со временем кадра и ошибкой
+    density_core.ensure_init()
+    world = np.eye(4, dtype=np.float32) if world is None else np.asarray(world, dtype=np.float32)
+    if bounds is None:
+        bounds = (vertices.min(axis=0), vertices.max(axis=0))
+    lo, hi = density_core.world_bounds(bounds, world)
+    particles = np.random.default_rng(0).uniform(lo, hi, (max(n_particles, 1), 3)).astype(np.float32)
+    sample = np.random.default_rng(1).choice(len(vertices), min(SAMPLE_VERTICES, len(vertices)), replace=False)
+    sample_verts = np.ascontiguousarray(vertices[sample])
+    reference = density_core.compute_density(sample_verts, particles, h, world, mode='brute', normalization='none',
+                                             kernel=kernel)
+    scale = max(float(reference.max()), 1e-30)
+    split, block_dim = density_core.LARGE_CELL_SPLIT, density_core.BLOCK_DIM
+    out = np.empty((1, len(vertices)), dtype=np.float32)
+    results = []
+    for n_threads in threads or (None,):
+        if n_threads is not None:
+            density_core.init(arch=arch, offline_cache=True, cpu_max_num_threads=n_threads)
+        for config in candidates(len(vertices), n_particles, kernel, fft):
+            config = dict(config, threads=n_threads)
+
+            def trial():
+                run_config(config, vertices, [particles], h, world, bounds, kernel, cutoff_factor, out)
+
+            try:
+                seconds = timed_trials(trial)
+            except ValueError as e:
+                print(f"Density tune: {config} skipped: {e}")
+                continue
+            error = float(np.abs(out[0, sample] - reference).max()) / scale
+            results.append(dict(config, ms=seconds * 1000, error=error))
+            print(f"Density tune: {config} {seconds * 1000:.2f} ms, error {error:.2e}")
+    accurate = [r for r in results if r["error"] <= tolerance] or results
+    best = min(accurate, key=lambda r: r["ms"])
+
+    if best["threads"] is not None and best["threads"] != threads[-1]:
+        density_core.init(arch=arch, offline_cache=True, cpu_max_num_threads=best["threads"])
+    # block_dim для лучшей конфигурации: на результат не влияет, только на раскладку
+    # цикла по потокам (GPU) или на размер порции итераций (CPU). 'fft' считается в numpy
+    best["block_dim"] = 0
+    if best["mode"] != 'fft':
+        for dim in block_dims:
+            config = dict(best, block_dim=dim)
+            ms = timed_trials(lambda: run_config(config, vertices, [particles], h, world, bounds,
+                                                 kernel, cutoff_factor, out)) * 1000
+            print(f"Density tune: block_dim {dim} {ms:.2f} ms")
+            if ms < best["ms"]:
+                best.update(block_dim=dim, ms=ms)
+    # Размер пакета: время на кадр при K одинаковых кадрах одним запуском ('large' и 'fft'
+    # считают кадры по очереди, для них пакет не важен)
+    best["batch"] = 1
+    if best["mode"] in ('grid', 'brute'):
+        per_frame = {}
+        for k in batches:
+            if k * n_particles > MAX_BATCH_PARTICLES:
+                break
+            batch_out = np.empty((k, len(vertices)), dtype=np.float32)
+            per_frame[k] = timed_trials(lambda: run_config(best, vertices, [particles] * k, h, world, bounds,
+                                                           kernel, cutoff_factor, batch_out)) / k
+        if per_frame:
+            best["batch"] = min(per_frame, key=per_frame.get)
+    density_core.LARGE_CELL_SPLIT, density_core.BLOCK_DIM = split, block_dim
+    return best
+
+
+def load(path=TUNE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(table, path=TUNE_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(table, f, indent=2)
+    os.replace(tmp, path)
+
+
+def tuned_config(vertices, n_particles, h, world=None, bounds=None, kernel='gaussian', cutoff_factor=3.0,
+                 path=TUNE_PATH, retune=False, fft=False, **kwargs):
+    # Сохранённая конфигурация для этой машины и задачи или новый подбор с записью в path
+    density_core.ensure_init()
+    table = load(path)
+    machine, problem = machine_key(), problem_key(len(vertices), n_particles, h, kernel, cutoff_factor, fft)
+    config = table.get(machine, {}).get(problem)
+    if config is not None and not retune:
+        print(f"Density tune: using saved {config['mode']} ({config['ms']:.2f} ms) for {problem}")
+        return config
+    t0 = time.perf_counter()
+    config = tune(vertices, n_particles, h, world, bounds, kernel, cutoff_factor, fft=fft, **kwargs)
+    config["tuned_s"] = time.perf_counter() - t0
+    config["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    table = load(path)  # могли записать параллельно
+    table.setdefault(machine, {})[problem] = config
+    save(table, path)
+    print(f"Density tune: {config} for {problem}, {config['tuned_s']:.1f} s -> {path}")
+    return config
+
+
+def apply(config, arch='cpu', **init_kw):
+    # Параметры density_core из конфигурации; режим, точность и пакет забирает вызывающий.
+    # С подобранным числом потоков Taichi перезапускается - ndarray, созданные до этого,
+    # вызывающий должен создать заново. Возвращает True, если был перезапуск
+    if "cell_split" in config:
+        density_core.LARGE_CELL_SPLIT = config["cell_split"]
+    if "block_dim" in config:
+        density_core.BLOCK_DIM = config["block_dim"]
+    if config.get("threads"):
+        density_core.init(arch=arch, cpu_max_num_threads=config["threads"], **init_kw)
+        return True
+    return False
+
+
+def main(argv=None):
+    import scene_mesh
+    parser = argparse.ArgumentParser(prog="density_tune.py", description="Автоподбор параметров плотности")
+    parser.add_argument("--level", type=int, default=2, help="уровень подразделения цилиндра из main()")
+    parser.add_argument("--particles", type=int, default=1000, help="число частиц")
+    parser.add_argument("--h", type=float, default=1.5, help="длина сглаживания")
+    parser.add_argument("--kernel", default="gaussian", help="ядро сглаживания")
+    parser.add_argument("--cutoff", type=float, default=3.0, help="обрезка гаусса в единицах h")
+    parser.add_argument("--arch", default="cpu", help="arch Taichi")
+    parser.add_argument("--threads", default="", help="потоков CPU через запятую для подбора")
+    parser.add_argument("--fft", action="store_true", help="пробовать режим 'fft'")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="допустимая ошибка от максимума")
+    parser.add_argument("--path", default=TUNE_PATH, help="файл сохранённых настроек")
+    parser.add_argument("--retune", action="store_true", help="подобрать заново, даже если сохранено")
+    args = parser.parse_args(argv)
+    density_core.init(arch=args.arch)
+    vertices = scene_mesh.open_cylinder(3.0, 15.0, level=args.level)[0]
+    threads = tuple(int(t) for t in args.threads.split(",") if t)
+    tuned_config(vertices, args.particles, args.h, kernel=args.kernel, cutoff_factor=args.cutoff, path=args.path,
+                 retune=args.retune, tolerance=args.tolerance, fft=args.fft, threads=threads, arch=args.arch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Замеры времени по стадиям кадра update_density.
+# begin(кадр) запоминает время, lap(стадия) прибавляет к стадии время с прошлой отметки,
+# end() закрывает кадр и кладёт его в кольцевой буфер последних N кадров. Время в мс,
+# по perf_counter_ns. С включённым профилировщиком ядер Taichi (ti.init(kernel_profiler=True))
+# в кадр добавляется суммарное время ядер на устройстве - стадия "kernels".
+# Когда замеры выключены, таймера просто нет (None), и в кадре остаются только проверки
+# "if timer:" - без вызовов и выделений памяти.
+import csv
+import json
+import time
+from collections import deque
+
+import numpy as np
+import taichi as ti
+
+
+class FrameTimer:
+    def __init__(self, frames=256, kernel_profiler=False):
+        self.records = deque(maxlen=frames)  # кадр -> {стадия: мс}
+        self.kernel_profiler = kernel_profiler
+        self.current = None
+        self.start = 0
+        self.last = 0
+        self.kernel_total = 0.0
+
+    def begin(self, frame):
+        self.current = {"frame": frame}
+        self.start = self.last = time.perf_counter_ns()
+
+    def lap(self, stage):
+        if self.current is None:
+            return  # вне кадра (например, frame_density из bake.py)
+        now = time.perf_counter_ns()
+        self.current[stage] = self.current.get(stage, 0.0) + (now - self.last) / 1e6
+        self.last = now
+
+    def end(self):
+        self.current["total"] = (time.perf_counter_ns() - self.start) / 1e6
+        if self.kernel_profiler:
+            # Профилировщик копит время с запуска, в кадр пишем приращение
+            total = ti.profiler.get_kernel_profiler_total_time()
+            self.current["kernels"] = (total - self.kernel_total) * 1e3
+            self.kernel_total = total
+        self.records.append(self.current)
+        self.current = None
+
+    def stages(self):
+        # Стадии в порядке первого появления, "total" последней
+        names = {}
+        for record in self.records:
+            names.update(dict.fromkeys(k for k in record if k not in ("frame", "total")))
+        return list(names) + ["total"]
+
+    def summary(self):
+        result = {}
+        for stage in self.stages():
+            values = np.array([r[stage] for r in self.records if stage in r])
+            if len(values):
+                result[stage] = {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+                                 "max": float(values.max()), "mean": float(values.mean()), "frames": len(values)}
+        return result
+
+    def report(self):
+        lines = [f"Frame timing, last {len(self.records)} frames (ms): stage p50 / p95 / max"]
+        for stage, s in self.summary().items():
+            lines.append(f"  {stage:<12} {s['p50']:8.2f} {s['p95']:8.2f} {s['max']:8.2f}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        # .csv - строка на кадр, иначе JSON с кадрами и сводкой
+        if path.endswith(".csv"):
+            fields = ["frame"] + self.stages()
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, "w") as f:
+                json.dump({"frames": list(self.records), "summary": self.summary()}, f, indent=2)
@@ -0,0 +1,251 @@
+# Чтение дискового кеша частиц Блендера (.bphys) без Блендера и без вычисления depsgraph.
+# Кеш пишется при point_cache.use_disk_cache: файл на кадр <префикс>_<кадр:06d>_<индекс:02d>.bphys,
+# префикс - имя кеша или, если оно пустое, имя объекта-эмиттера в hex. Кадр 0 - служебный:
+# время рождения, смерти и жизни каждой частицы системы.
+#
+# Файл: b"BPHYSICS", uint32 тип | флаги, uint32 число точек, uint32 маска полей, затем поля.
+# Без сжатия поля идут по точкам подряд (поля точки в порядке битов маски) - такой файл
+# читается через memmap как структурный массив. Со сжатием каждое поле пишется отдельным
+# блоком: байт способа (0 - без сжатия, 1 - LZO, 2 - LZMA), для сжатых - uint32 длина,
+# данные, а для LZMA ещё uint32 длина и свойства кодера. LZMA распаковывается стандартным
+# модулем lzma, LZO в стандартной библиотеке нет - для него кеш нужно писать без сжатия.
+# В кадре лежат только частицы вблизи своей жизни, номер частицы - в поле INDEX.
+#
+# Между записанными кадрами (шаг кеша больше 1 или дробный кадр) координаты
+# интерполируются линейно, Блендер делает это по Эрмиту со скоростями.
+#
+#   python point_cache.py blendcache_проект --object Particle_Emitter --start 1 --end 250 --out density.dens
+import argparse
+import json
+import lzma
+import os
+import re
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b"BPHYSICS"
+HEADER = struct.Struct("<8sIII")  # магия, тип | флаги, число точек, маска полей
+TYPE_PARTICLES = 1
+TYPEFLAG_COMPRESS = 0x10000
+TYPEMASK = 0xFFFF
+# Поля кеша по номеру бита: имя, тип и число компонент
+FIELDS = [
+    ("index", np.uint32, 1),
+    ("location", np.float32, 3),
+    ("velocity", np.float32, 3),
+    ("rotation", np.float32, 4),
+    ("avelocity", np.float32, 3),
+    ("size", np.float32, 1),
+    ("times", np.float32, 3),  # рождение, смерть, время жизни
+    ("boids", np.uint8, 20),
+]
+COMPRESS_NONE, COMPRESS_LZO, COMPRESS_LZMA = 0, 1, 2
+
+
+def cache_prefix(cache_name, object_name):
+    # Префикс файлов кеша: имя кеша или hex имени объекта, как у Блендера
+    return cache_name or object_name.encode().hex().upper()
+
+
+def record_dtype(mask):
+    return np.dtype([(name, dtype, (n,)) for bit, (name, dtype, n) in enumerate(FIELDS) if mask & (1 << bit)])
+
+
+def lzma_block(data, props, size):
+    # Сырой поток LZMA1 без заголовка, свойства - 5 байт LzmaCompress
+    d = props[0]
+    filters = [{"id": lzma.FILTER_LZMA1, "dict_size": struct.unpack("<I", props[1:5])[0],
+                "lc": d % 9, "lp": d // 9 % 5, "pb": d // 45}]
+    return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters).decompress(data, size)
+
+
+def read_frame_file(path):
+    # Поля одного файла кеша: имя -> массив (точек, компонент); без сжатия - представления memmap
+    with open(path, "rb") as f:
+        magic, typeflag, count, mask = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path}: не файл кеша Блендера .bphys")
+        if typeflag & TYPEMASK != TYPE_PARTICLES:
+            raise ValueError(f"{path}: кеш не системы частиц (тип {typeflag & TYPEMASK})")
+        if not typeflag & TYPEFLAG_COMPRESS:
+            records = np.memmap(path, dtype=record_dtype(mask), mode='r', offset=HEADER.size, shape=(count,))
+            return {name: records[name] for name in records.dtype.names}
+        fields = {}
+        for bit, (name, dtype, n) in enumerate(FIELDS):
+            if not mask & (1 << bit):
+                continue
+            size = count * np.dtype(dtype).itemsize * n
+            method = f.read(1)[0]
+            if method == COMPRESS_NONE:
+                data = f.read(size)
+            else:
+                (length,) = struct.unpack("<I", f.read(4))
+                data = f.read(length)
+                if method != COMPRESS_LZMA:
+                    raise ValueError(f"{path}: сжатие LZO не поддерживается, запеките кеш без сжатия")
+                (props_size,) = struct.unpack("<I", f.read(4))
+                data = lzma_block(data, f.read(props_size), size)
+            fields[name] = np.frombuffer(data, dtype=dtype, count=count * n).reshape(count, n)
+        return fields
+
+
+class PointCacheReader:
+    # Частицы одной системы по кадрам из файлов кеша: те же координаты (P, 3) float32
+    # и маска живых (P,), что actualcode.read_particles читает через depsgraph
+    def __init__(self, directory, prefix, index=0):
+        self.directory = directory
+        self.prefix = prefix
+        self.index = index
+        pattern = re.compile(re.escape(prefix) + r"_(\d{6})_%02d\.bphys$" % index)
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        frames = sorted(int(m.group(1)) for m in map(pattern.match, names) if m)
+        self.times = None
+        self.times_mtime = None
+        if frames and frames[0] == 0:
+            self.refresh_times()
+            frames = frames[1:]
+        self.frames = np.array(frames, dtype=np.int64)
+        if self.times is not None:
+            self.count = len(self.times)
+        else:
+            # Без служебного кадра число частиц - по наибольшему номеру во всех кадрах
+            self.count = max((int(read_frame_file(self.path(f))["index"].max()) + 1 for f in frames), default=0)
+        self.loaded = {}  # кадр -> (mtime файла, координаты, есть ли в кадре), два последних
+
+    def __len__(self):
+        return self.count
+
+    def path(self, frame):
+        return os.path.join(self.directory, "%s_%06d_%02d.bphys" % (self.prefix, frame, self.index))
+
+    def refresh_times(self):
+        # Служебный кадр перечитывается, если файл переписан (перезапечка)
+        mtime = os.stat(self.path(0)).st_mtime_ns
+        if mtime != self.times_mtime:
+            self.times = np.array(read_frame_file(self.path(0))["times"])
+            self.times_mtime = mtime
+
+    def load(self, frame):
+        # Загруженный кадр берётся повторно, только пока его файл не переписан
+        mtime = os.stat(self.path(frame)).st_mtime_ns
+        if frame not in self.loaded or self.loaded[frame][0] != mtime:
+            self.loaded.pop(frame, None)
+            fields = read_frame_file(self.path(frame))
+            index = fields["index"][:, 0]
+            positions = np.zeros((self.count, 3), dtype=np.float32)
+            present = np.zeros(self.count, dtype=np.bool_)
+            positions[index] = fields["location"]
+            present[index] = True
+            if len(self.loaded) >= 2:
+                del self.loaded[next(iter(self.loaded))]
+            self.loaded[frame] = (mtime, positions, present)
+        return self.loaded[frame][1:]
+
+    def read(self, frame, positions=None, alive=None):
+        # Координаты и маска живых на кадре frame (можно дробном); out-буферы по желанию
+        if not len(self.frames):
+            raise ValueError(f"В {self.directory} нет кеша {self.prefix} (индекс {self.index})")
+        if positions is None:
+            positions = np.empty((self.count, 3), dtype=np.float32)
+        if alive is None:
+            alive = np.empty(self.count, dtype=np.bool_)
+        k = int(np.searchsorted(self.frames, frame, side='right'))
+        f0 = self.frames[max(k - 1, 0)]
+        f1 = self.frames[min(k, len(self.frames) - 1)]
+        p0, present0 = self.load(f0)
+        if f1 == f0 or frame <= f0:
+            positions[:] = p0
+            alive[:] = present0
+        else:
+            p1, present1 = self.load(f1)
+            t = np.float32((frame - f0) / (f1 - f0))
+            np.multiply(p0, 1 - t, out=positions)
+            positions += t * p1
+            # Частица есть только в одном из кадров - берём её координаты как есть
+            positions[~present1] = p0[~present1]
+            positions[~present0] = p1[~present0]
+            np.logical_or(present0, present1, out=alive)
+        if self.times is not None:
+            self.refresh_times()
+            # Как в read_particles: родилась не позже кадра и умрёт позже него
+            alive &= (self.times[:, 0] <= frame) & (self.times[:, 1] > frame)
+        return positions, alive
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="point_cache.py",
+                                     description="Плотность частиц на цилиндре из дискового кеша частиц, без Блендера")
+    parser.add_argument("directory", help="папка кеша (blendcache_<имя .blend>)")
+    parser.add_argument("--object", default="Particle_Emitter", help="имя объекта-эмиттера")
+    parser.add_argument("--cache-name", default="", help="имя кеша, если задано в Блендере")
+    parser.add_argument("--index", type=int, default=0, help="индекс кеша (point_cache.index)")
+    parser.add_argument("--start", type=int, default=None, help="первый кадр (по умолчанию первый в кеше)")
+    parser.add_argument("--end", type=int, default=None, help="последний кадр (по умолчанию последний в кеше)")
+    parser.add_argument("--out", default="density_bake.npy", help="файл .npy или .dens")
+    parser.add_argument("--radius", type=float, default=3.0, help="радиус цилиндра")
+    parser.add_argument("--height", type=float, default=15.0, help="высота цилиндра")
+    parser.add_argument("--level", type=int, default=2, help="уровень подразделения цилиндра")
+    parser.add_argument("--h", type=float, default=1.5, help="длина сглаживания")
+    parser.add_argument("--kernel", default="gaussian", help="ядро сглаживания")
+    parser.add_argument("--mode", default="grid", help="режим density_core")
+    parser.add_argument("--bits", type=int, default=8, choices=(8, 16), help="квантование для .dens")
+    parser.add_argument("--batch", type=int, default=8, help="кадров в пакете")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # Запечка плотности вне Блендера: цилиндр из main() actualcode (ось по X) и частицы из кеша
+    import density_core
+    import scene_mesh
+    from density_lod import LOD_SPACING
+    from density_store import DensityWriter
+    args = parse_args(argv)
+    reader = PointCacheReader(args.directory, cache_prefix(args.cache_name, args.object), args.index)
+    if not len(reader.frames):
+        raise SystemExit(f"В {args.directory} нет кеша {reader.prefix}")
+    frame_start = int(reader.frames[0]) if args.start is None else args.start
+    frame_end = int(reader.frames[-1]) if args.end is None else args.end
+    vertices = scene_mesh.open_cylinder(args.radius, args.height, level=args.level)[0]
+    world = np.array([[0, 0, 1, 0], [0, 1, 0, 0], [-1, 0, 0, 0], [0, 0, 0, 1]], dtype=np.float32)  # поворот по Y на 90
+    n_frames = frame_end - frame_start + 1
+    if args.out.endswith(".dens"):
+        out = DensityWriter(args.out, len(vertices), frame_start, args.bits)
+    else:
+        out = np.lib.format.open_memmap(args.out, mode='w+', dtype=np.float32, shape=(n_frames, len(vertices)))
+    checks = []
+    t0 = time.perf_counter()
+    for k0 in range(0, n_frames, args.batch):
+        frames = []
+        for frame in range(frame_start + k0, min(frame_start + k0 + args.batch, frame_end + 1)):
+            positions, alive = reader.read(frame)
+            # Тот же crc32, что actualcode.particle_check: сверка частиц по кадрам при загрузке
+            checks.append(zlib.crc32(alive, zlib.crc32(positions[alive])))
+            frames.append(positions[alive])
+        density = density_core.compute_density_batch(vertices, frames, args.h, world, args.mode, kernel=args.kernel)
+        if args.out.endswith(".dens"):
+            for row in density:
+                out.write(row)
+        else:
+            out[k0:k0 + len(density)] = density
+    if args.out.endswith(".dens"):
+        out.close()
+    else:
+        out.flush()
+    del out
+    elapsed = time.perf_counter() - t0
+    with open(args.out + ".json", "w") as f:
+        json.dump({"frame_start": frame_start, "frame_end": frame_end, "vertices": len(vertices),
+                   "objects": ["Hollow_Cylinder"], "smoothing_length": args.h,
+                   "kernel": {"smoothing_length": args.h, "kernel": args.kernel, "cutoff_factor": 3.0,
+                              "mode": args.mode, "normalization": 'max', "reference": 1.0,
+                              "lod": False, "lod_spacing": LOD_SPACING, "large_half": True},
+                   "particle_checks": checks, "seconds": elapsed}, f, indent=2)
+    print(f"Baked frames {frame_start}-{frame_end} ({len(vertices)} vertices, {len(reader)} particles) "
+          f"from point cache to {args.out}: {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
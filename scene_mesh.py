@@ -0,0 +1,38 @@
+# Геометрия сцены на numpy без Блендера: вершины (N, 3) float32 и четырёхугольники (M, 4) int32.
+# actualcode.py собирает из них меши через from_pydata без операторов и режима правки,
+# поэтому сцена строится и в Blender --background; benchmark.py берёт тот же цилиндр.
+import numpy as np
+
+
+def open_cylinder(radius, height, segments=32, level=0):
+    # Боковая поверхность цилиндра без торцов, ось - Z, высота от -height/2 до height/2.
+    # Сетка сразу в разрешении подразделения уровня level: segments * 2^level вершин
+    # по окружности и 2^level + 1 колец по высоте - как у primitive_cylinder_add с удалёнными
+    # торцами и применённым Subdivision, но вершины лежат точно на окружности радиуса radius.
+    # Вершина (t, z) имеет индекс t * (колец) + z, нормали граней смотрят наружу
+    nt = segments * 2 ** level
+    nz = 2 ** level + 1
+    theta = np.repeat(np.linspace(0.0, 2.0 * np.pi, nt, endpoint=False), nz)
+    z = np.tile(np.linspace(-height / 2, height / 2, nz), nt)
+    verts = np.stack([radius * np.cos(theta), radius * np.sin(theta), z], axis=1).astype(np.float32)
+    t, k = np.meshgrid(np.arange(nt), np.arange(nz - 1), indexing='ij')
+    a = t * nz + k
+    b = (t + 1) % nt * nz + k
+    faces = np.stack([a, b, b + 1, a + 1], axis=-1).reshape(-1, 4).astype(np.int32)
+    return verts, faces
+
+
+def box(size=2.0):
+    # Куб с ребром size с центром в начале координат, как у primitive_cube_add
+    s = size / 2
+    verts = np.array([[x, y, z] for x in (-s, s) for y in (-s, s) for z in (-s, s)], dtype=np.float32)
+    faces = np.array([[0, 1, 3, 2], [2, 3, 7, 6], [6, 7, 5, 4], [4, 5, 1, 0], [2, 6, 4, 0], [7, 3, 1, 5]],
+                     dtype=np.int32)
+    return verts, faces
+
+
+def plane(size=2.0):
+    # Квадрат со стороной size в плоскости XY, нормаль +Z, как у primitive_plane_add
+    s = size / 2
+    verts = np.array([[-s, -s, 0.0], [s, -s, 0.0], [s, s, 0.0], [-s, s, 0.0]], dtype=np.float32)
+    return verts, np.array([[0, 1, 2, 3]], dtype=np.int32)
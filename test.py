@@ -1,5 +1,98 @@
-import numpy as np
-import taichi as ti
-
-print(f"Taichi работает! Версия: {ti.__version__}")
-print(f"NumPy работает! Версия: {np.__version__}")
+# Проверки: python test.py; дисковый кеш частиц - только в Блендере:
+#   blender --background --python test.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+import taichi as ti
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+print(f"Taichi работает! Версия: {ti.__version__}")
+print(f"NumPy работает! Версия: {np.__version__}")
+
+# Трассировка инкрементального режима: значение * множитель строки равно возвращённой плотности
+import density_core
+import scene_mesh
+
+density_core.TRACE_STRIDE = 16
+density_core.init(arch='cpu', trace=True)
+verts = scene_mesh.open_cylinder(3.0, 15.0, level=2)[0]
+rng = np.random.default_rng(0)
+positions = rng.uniform(verts.min(axis=0), verts.max(axis=0), (2000, 3)).astype(np.float32)
+alive = np.ones(len(positions), dtype=bool)
+inc = density_core.IncrementalDensity()
+rows = []
+for frame in range(1, 9):
+    positions[rng.integers(0, len(positions), 200)] += rng.normal(0.0, 0.3, (200, 3)).astype(np.float32)
+    alive[rng.integers(0, len(positions), 20)] ^= True
+    rows.append(inc.update(frame, verts, positions, alive, 1.5, normalization='max').copy())
+assert inc.full_updates == 1 and inc.incremental_updates == 7
+assert density_core.check_trace(np.stack(rows)) < 1e-6
+print("Трассировка совпадает с плотностью")
+
+# Файлы .bphys в формате Блендера (без сжатия и LZMA) читаются PointCacheReader обратно
+import lzma
+import struct
+
+import point_cache
+
+cache_dir = tempfile.mkdtemp()
+prefix = point_cache.cache_prefix("", "Particle_Emitter")
+birth = rng.uniform(1, 20, 500).astype(np.float32)
+death = birth + 30
+start, velocity = rng.normal(size=(2, 500, 3)).astype(np.float32)
+
+
+def write_bphys(frame, fields, mask, compress=False):
+    count = len(next(iter(fields.values())))
+    typeflag = point_cache.TYPE_PARTICLES | (point_cache.TYPEFLAG_COMPRESS if compress else 0)
+    with open(os.path.join(cache_dir, "%s_%06d_00.bphys" % (prefix, frame)), "wb") as f:
+        f.write(point_cache.HEADER.pack(point_cache.MAGIC, typeflag, count, mask))
+        if not compress:
+            records = np.zeros(count, point_cache.record_dtype(mask))
+            for name in records.dtype.names:
+                records[name] = fields[name]
+            f.write(records.tobytes())
+            return
+        props = {"id": lzma.FILTER_LZMA1, "dict_size": 1 << 16, "lc": 3, "lp": 0, "pb": 2}
+        for bit, (name, _, _) in enumerate(point_cache.FIELDS):
+            if mask & (1 << bit):
+                data = lzma.compress(np.ascontiguousarray(fields[name]).tobytes(), format=lzma.FORMAT_RAW,
+                                     filters=[props])
+                f.write(bytes([point_cache.COMPRESS_LZMA]) + struct.pack("<I", len(data)) + data
+                        + struct.pack("<I", 5) + bytes([(2 * 5 + 0) * 9 + 3]) + struct.pack("<I", 1 << 16))
+
+
+write_bphys(0, {"times": np.stack([birth, death, death - birth], axis=1)}, 1 << 6)
+for frame in range(1, 41, 2):
+    sel = np.flatnonzero((frame >= birth - 1) & (frame <= death + 1))
+    write_bphys(frame, {"index": sel[:, None].astype(np.uint32), "location": (start + frame * velocity)[sel],
+                        "velocity": velocity[sel]}, 0b111, compress=frame % 4 == 1)
+reader = point_cache.PointCacheReader(cache_dir, prefix)
+assert len(reader) == 500 and list(reader.frames) == list(range(1, 41, 2))
+for frame in (5, 6, 7.5):
+    positions, alive = reader.read(frame)
+    assert np.array_equal(alive, (birth <= frame) & (death > frame))
+    assert np.abs(positions[alive] - (start + frame * velocity)[alive]).max() < 1e-4
+print("Кеш частиц .bphys читается обратно")
+
+# Запечённый Блендером дисковый кеш читается point_cache.py так же, как его читает Блендер
+try:
+    import bpy
+except ImportError:
+    bpy = None
+if bpy is None:
+    print("bpy нет - проверка дискового кеша частиц пропущена")
+else:
+    import actualcode
+    # Дисковый кеш Блендер включает только у сохранённого файла
+    bpy.ops.wm.save_as_mainfile(filepath=os.path.join(tempfile.mkdtemp(), "point_cache_test.blend"))
+    actualcode.POINT_CACHE_DISK = True
+    actualcode.main()
+    result = actualcode.check_point_cache()
+    assert result is not None, "кеш частиц не записан на диск"
+    max_err, mismatches = result
+    assert max_err < 1e-6 and mismatches == 0
+    print("Дисковый кеш частиц совпадает с depsgraph")